@@ -9,4 +9,5 @@ def get_data(path):
     return os.path.join(_ROOT, 'data', path)
 
 __all__ = ['gpx', 'db', 'cmdline', 'helper', 'spatialite_finder', 'db_helper',
+           'segment', 'sources', 'cache', 'locations',
            'gpx2spatialite']
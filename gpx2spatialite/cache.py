@@ -0,0 +1,370 @@
+# Copyright (C) 2013, 2014
+# Daniel Belasco Rogers <http://planbperformance.net/dan>,
+# Peter Vasil <mail@petervasil.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see [http://www.gnu.org/licenses/].
+
+import os
+import struct
+import sys
+import uuid
+import zlib
+from array import array
+from gpxpy import gpxfield
+from .segment import TrackSegment, from_epoch, to_epoch
+
+
+# version 2 of the entry format, entries of other versions are ignored
+MAGIC = b'G2SCACHE\x02'
+EXTENSION = '.g2sc'
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# array.tobytes and array.frombytes are called tostring and fromstring
+# in Python 2
+if hasattr(array, 'tobytes'):
+    _array_tobytes = array.tobytes
+    _array_frombytes = array.frombytes
+else:
+    _array_tobytes = array.tostring
+    _array_frombytes = array.fromstring
+
+_SEGMENT = b'S'
+_WAYPOINT = b'W'
+_TIMESTAMPS = b'T'
+
+# number of points, length_m, time_sec, speed_kph
+_SEGMENT_HEADER = struct.Struct('<Iddd')
+# seconds since the epoch (NaN for no time) and utc offset
+_TIME = struct.Struct('<di')
+_NO_TZ = -0x80000000
+_FLOAT = struct.Struct('<d')
+# utc offset in minutes or _NO_TZ for naive datetimes
+_TZ = struct.Struct('<i')
+# number of points with another utc offset than their segment, index
+_COUNT = struct.Struct('<I')
+# length of an utf-8 string, -1 for None
+_STRING = struct.Struct('<i')
+_CRC = struct.Struct('<I')
+
+_NAN = float('nan')
+
+
+class CacheError(Exception):
+    """Raised for cache entries which can not be read"""
+
+
+class ParseCache(object):
+    """
+    On-disk cache of parsed gpx files, keyed by the md5 hash of the file
+    content (see gpx.iterextract).
+
+    An entry holds the point columns, the statistics, the time zone and
+    the timestamps of points in other time zones of every segment, the
+    waypoints as parsed and the file's first and last timestamp in a
+    compact binary format. Locations and geometries are
+    not cached, they are computed again when an entry is read, so entries
+    stay valid when citydefs or import options change.
+
+    Every entry is a file in directory. Reading an entry updates its
+    modification time and the least recently used entries are removed
+    once all entries take more than max_size bytes. The size of all
+    entries is read from the directory once and then kept up to date
+    while entries are added, so the directory is only listed again when
+    entries have to be removed.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # size of all entries, None until the directory was listed
+        self.total_size = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_path(self, md5hash):
+        """
+        Return the path of the entry of md5hash
+        """
+        return os.path.join(self.directory, md5hash + EXTENSION)
+
+    def load(self, md5hash):
+        """
+        Return the records of the cached file with the hash md5hash, None
+        if it is not in the cache (see read_records). Unreadable entries
+        are removed.
+        """
+        path = self.get_path(md5hash)
+        try:
+            with open(path, 'rb') as entry_file:
+                data = entry_file.read()
+        except EnvironmentError:
+            return None
+
+        try:
+            records = read_records(data)
+        except CacheError:
+            _remove(path)
+            return None
+
+        try:
+            os.utime(path, None)
+        except EnvironmentError:
+            pass
+        return records
+
+    def writer(self, md5hash):
+        """
+        Return a CacheWriter for the file with the hash md5hash
+        """
+        return CacheWriter(self, md5hash)
+
+    def add_entry(self, size):
+        """
+        Count a new entry of size bytes and remove least recently used
+        entries if the cache got too large
+        """
+        if self.total_size is None:
+            self.evict()
+            return
+        self.total_size += size
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until all entries take at
+        most max_size bytes. Returns the number of removed entries.
+        """
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except EnvironmentError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+            total_size += stat.st_size
+
+        num_removed = 0
+        entries.sort()
+        for mtime, path, size in entries:
+            if total_size <= self.max_size:
+                break
+            _remove(path)
+            total_size -= size
+            num_removed += 1
+        self.total_size = total_size
+        return num_removed
+
+
+class CacheWriter(object):
+    """
+    Writes a cache entry while a file is parsed. The entry only becomes
+    visible to ParseCache.load once commit is called, discard drops an
+    uncommitted entry.
+    """
+
+    def __init__(self, cache, md5hash):
+        self.cache = cache
+        self.path = cache.get_path(md5hash)
+        self.tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        self.entry_file = open(self.tmp_path, 'wb')
+        self.entry_file.write(MAGIC)
+        self.crc = 0
+
+    def _write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.entry_file.write(data)
+
+    def add_segment(self, segment):
+        """
+        Add a TrackSegment, its locations are not stored
+        """
+        parts = [_SEGMENT,
+                 _SEGMENT_HEADER.pack(len(segment), segment.length_m,
+                                      segment.time_sec, segment.speed_kph),
+                 _pack_tz(segment)]
+        for column in (segment.lon, segment.lat, segment.ele, segment.time,
+                       segment.speed, segment.course):
+            if sys.byteorder == 'big':
+                column = array('d', column)
+                column.byteswap()
+            parts.append(_array_tobytes(column))
+        parts.append(_COUNT.pack(len(segment.other_times)))
+        for index, time in sorted(segment.other_times.items()):
+            parts.append(_COUNT.pack(index) + _pack_time(time))
+        self._write(b''.join(parts))
+
+    def add_waypoint(self, wpt):
+        """
+        Add a waypoint as parsed: lat, lon, ele, time, name, symbol
+        """
+        lat, lon, ele, time, name, symbol = wpt
+        self._write(b''.join([
+            _WAYPOINT, _FLOAT.pack(lat), _FLOAT.pack(lon),
+            _FLOAT.pack(_NAN if ele is None else ele), _pack_time(time),
+            _pack_string(name), _pack_string(symbol)]))
+
+    def commit(self, firsttimestamp, lasttimestamp):
+        """
+        Finish the entry with the file's first and last timestamp and
+        remove least recently used entries if the cache got too large
+        """
+        self._write(_TIMESTAMPS + _pack_time(firsttimestamp) +
+                    _pack_time(lasttimestamp))
+        self.entry_file.write(_CRC.pack(self.crc & 0xffffffff))
+        size = self.entry_file.tell()
+        self.entry_file.close()
+        try:
+            os.rename(self.tmp_path, self.path)
+        except EnvironmentError:
+            _remove(self.tmp_path)
+            return
+        self.cache.add_entry(size)
+
+    def discard(self):
+        """
+        Drop the entry unless it has been committed
+        """
+        if self.entry_file.closed:
+            return
+        self.entry_file.close()
+        _remove(self.tmp_path)
+
+
+def read_records(data):
+    """
+    Check the cache entry data and return a generator of its records:
+    ('segment', TrackSegment) without locations, ('wpt', wpt) with the
+    waypoint as parsed and finally ('timestamps', (first, last)).
+    Raises CacheError if the entry is incomplete or corrupt.
+    """
+    if len(data) < len(MAGIC) + _CRC.size or not data.startswith(MAGIC):
+        raise CacheError("Not a cache entry")
+    end = len(data) - _CRC.size
+    crc = _CRC.unpack_from(data, end)[0]
+    if zlib.crc32(data[len(MAGIC):end]) & 0xffffffff != crc:
+        raise CacheError("Corrupt cache entry")
+    return _iter_records(data, len(MAGIC))
+
+
+def _iter_records(data, offset):
+    while True:
+        kind = data[offset:offset + 1]
+        offset += 1
+        if kind == _SEGMENT:
+            num_points, length_m, time_sec, speed_kph = \
+                _SEGMENT_HEADER.unpack_from(data, offset)
+            offset += _SEGMENT_HEADER.size
+            segment = TrackSegment(uuid.uuid4())
+            segment.tzinfo, segment.utcoffset, offset = _unpack_tz(data,
+                                                                   offset)
+            segment.offset = None
+            if segment.tzinfo is not None:
+                segment.offset = segment.utcoffset
+            for name in ('lon', 'lat', 'ele', 'time', 'speed', 'course'):
+                column = array('d')
+                _array_frombytes(column, data[offset:offset + 8 * num_points])
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                setattr(segment, name, column)
+                offset += 8 * num_points
+            num_other = _COUNT.unpack_from(data, offset)[0]
+            offset += _COUNT.size
+            for _ in range(num_other):
+                index = _COUNT.unpack_from(data, offset)[0]
+                segment.other_times[index], offset = _unpack_time(
+                    data, offset + _COUNT.size)
+            segment.loc = array('l', [-1]) * num_points
+            segment.timestamp_start, segment.timestamp_end = \
+                segment.get_time_bounds()
+            segment.length_m = length_m
+            segment.time_sec = time_sec
+            segment.speed_kph = speed_kph
+            yield 'segment', segment
+        elif kind == _WAYPOINT:
+            lat, lon, ele = struct.unpack_from('<ddd', data, offset)
+            offset += 24
+            time, offset = _unpack_time(data, offset)
+            name, offset = _unpack_string(data, offset)
+            symbol, offset = _unpack_string(data, offset)
+            yield 'wpt', (lat, lon, None if ele != ele else ele, time,
+                          name, symbol)
+        else:
+            firsttimestamp, offset = _unpack_time(data, offset)
+            lasttimestamp, offset = _unpack_time(data, offset)
+            yield 'timestamps', (firsttimestamp, lasttimestamp)
+            return
+
+
+def _pack_tz(segment):
+    if segment.tzinfo is None or segment.offset is None:
+        return _TZ.pack(_NO_TZ)
+    return _TZ.pack(int(round(segment.utcoffset / 60)))
+
+
+def _unpack_tz(data, offset):
+    minutes = _TZ.unpack_from(data, offset)[0]
+    offset += _TZ.size
+    if minutes == _NO_TZ:
+        return None, 0.0, offset
+    tzinfo = gpxfield.SimpleTZ()
+    tzinfo.offset = minutes
+    return tzinfo, minutes * 60.0, offset
+
+
+def _pack_time(time):
+    if time is None:
+        return _TIME.pack(_NAN, _NO_TZ)
+    offset = time.utcoffset()
+    if time.tzinfo is None or offset is None:
+        return _TIME.pack(to_epoch(time), _NO_TZ)
+    return _TIME.pack(to_epoch(time),
+                      int(round(offset.total_seconds() / 60)))
+
+
+def _unpack_time(data, offset):
+    seconds, minutes = _TIME.unpack_from(data, offset)
+    offset += _TIME.size
+    if minutes == _NO_TZ:
+        return from_epoch(seconds), offset
+    tzinfo = gpxfield.SimpleTZ()
+    tzinfo.offset = minutes
+    return from_epoch(seconds, minutes * 60.0, tzinfo), offset
+
+
+def _pack_string(value):
+    if value is None:
+        return _STRING.pack(-1)
+    encoded = value.encode('utf-8')
+    return _STRING.pack(len(encoded)) + encoded
+
+
+def _unpack_string(data, offset):
+    length = _STRING.unpack_from(data, offset)[0]
+    offset += _STRING.size
+    if length < 0:
+        return None, offset
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except EnvironmentError:
+        pass
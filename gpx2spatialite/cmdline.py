@@ -18,10 +18,14 @@
 
 import os.path
 import glob
+from . import sources
 
 
 print_verbose = True
 
+# orders of the files of an import, see sort_filepaths
+FILE_ORDERS = ['input', 'path', 'mtime']
+
 
 def set_print_verbose(is_verbose):
     global print_verbose
@@ -77,22 +81,32 @@ def read_filepaths_from_directory(rootdir, fileextension):
 
     paths = []
     for rootfolder, subfolders, files in os.walk(rootdir):
-        filtered_files = [f for f in files if f.lower().endswith(
-            fileextension)]
-        for filename in filtered_files:
-            filepath = glob.glob(os.path.join(rootfolder, filename))
-            if isinstance(filepath, str):
-                paths.append(filepath)
-            if isinstance(filepath, list):
-                paths += filepath
+        for filename in files:
+            paths += read_gpx_filepaths(os.path.join(rootfolder, filename),
+                                        fileextension)
     return paths
 
 
+def read_gpx_filepaths(filepath, fileextension):
+    """
+    Returns [filepath] if the file ends with the given file extension,
+    optionally followed by the extension of a compressed file (.gz, .bz2,
+    .xz). For zip and tar archives the paths of the members ending with
+    the file extension are returned.
+    """
+    if sources.is_archive(filepath) and os.path.isfile(filepath):
+        return sources.list_archive(filepath, fileextension)
+    if sources.is_gpx_path(filepath, fileextension):
+        return [filepath]
+    return []
+
+
 def read_filepaths(resource_paths, fileextension):
     """
     Returns a list of file paths read from the given resource paths.
     A resource can be a file or a folder.
-    Files will be filtered by the given file extension.
+    Files will be filtered by the given file extension (see
+    read_gpx_filepaths for compressed files and archives).
     File names are handled case-insensitive.
     """
     if not isinstance(resource_paths, list):
@@ -105,10 +119,26 @@ def read_filepaths(resource_paths, fileextension):
                                                       fileextension)
             paths.extend(filepaths)
         elif os.path.isfile(resource_path) is True:
-            if resource_path.lower().endswith(fileextension):
-                paths.append(resource_path)
+            paths += read_gpx_filepaths(resource_path, fileextension)
         else:
             for fi in glob.glob(resource_path):
-                if fi.lower().endswith(fileextension):
-                    paths.append(fi)
+                paths += read_gpx_filepaths(fi, fileextension)
     return paths
+
+
+def sort_filepaths(filepaths, order):
+    """
+    Returns the file paths in the order they are imported in, which is
+    also the order of their file_uids. 'input' keeps the order they were
+    found in, 'path' sorts them by path and 'mtime' by modification time.
+    Members of an archive get the modification time of the archive and
+    keep their order inside the archive.
+    """
+    if order == 'input':
+        return list(filepaths)
+    elif order == 'path':
+        return sorted(filepaths)
+    elif order == 'mtime':
+        return sorted(filepaths, key=lambda filepath: os.stat(
+            sources.split_archive_path(filepath)[0]).st_mtime)
+    raise ValueError("Unknown file order: {0}".format(order))
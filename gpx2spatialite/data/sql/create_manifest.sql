@@ -0,0 +1,14 @@
+-- Creates the import manifest table.
+-- It maps the path of every imported file to its size, modification
+-- time and inode at import time, so that unchanged files can be
+-- skipped on the next import without hashing them.
+
+CREATE TABLE IF NOT EXISTS import_manifest (
+filepath TEXT NOT NULL PRIMARY KEY,
+size INTEGER NOT NULL,
+mtime_ns INTEGER NOT NULL,
+inode INTEGER NOT NULL,
+md5hash TEXT NOT NULL,
+file_uid INTEGER,
+FOREIGN KEY (file_uid)
+REFERENCES files (file_uid) ON DELETE CASCADE ON UPDATE CASCADE);
@@ -20,18 +20,27 @@ import sys
 import os.path
 import re
 from datetime import datetime
-from functools import partial
 from . import spatialite_finder
+from . import db_helper
 from . import helper
+from . import locations
 
 
-def enterfile(filepath, cursor, user, firsttimestamp, lasttimestamp):
+# number of rows handed to a single executemany call
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def enterfile(filepath, cursor, user, firsttimestamp, lasttimestamp,
+              md5hash=None):
     """
     Enters the file in the files database table for future tracking
+    and returns the file_uid of the new row. The md5 hash of the file
+    is computed unless it is passed in.
     """
     # define fields required for file insert
     filename = os.path.split(filepath)[1]
-    md5hash = helper.getmd5(filepath)
+    if md5hash is None:
+        md5hash = helper.getmd5(filepath)
     date_entered = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # build sql
@@ -53,7 +62,40 @@ def enterfile(filepath, cursor, user, firsttimestamp, lasttimestamp):
         print("*" * 43)
         sys.exit(2)
 
-    return
+    return cursor.lastrowid
+
+
+def update_file_timestamps(cursor, file_uid, firsttimestamp, lasttimestamp):
+    """
+    Set the first and last timestamp of a file entered before its points
+    were parsed
+    """
+    sql = ("UPDATE files SET first_timestamp = ?, last_timestamp = ? "
+           "WHERE file_uid = ?")
+    cursor.execute(sql, (str(firsttimestamp), str(lasttimestamp), file_uid))
+
+
+def savepoint(cursor, name):
+    """
+    Start a savepoint which can be rolled back on its own
+    """
+    cursor.execute("SAVEPOINT {0}".format(name))
+
+
+def release_savepoint(cursor, name):
+    """
+    Keep the changes made since the savepoint as part of the enclosing
+    transaction
+    """
+    cursor.execute("RELEASE SAVEPOINT {0}".format(name))
+
+
+def rollback_to_savepoint(cursor, name):
+    """
+    Undo the changes made since the savepoint and release it
+    """
+    cursor.execute("ROLLBACK TO SAVEPOINT {0}".format(name))
+    release_savepoint(cursor, name)
 
 
 def get_currentfileid(cursor):
@@ -89,13 +131,89 @@ def insert_segments(cursor, segment_uuids):
     """
     segments_dict = {}
     for seg_uuid in segment_uuids:
-        insert_segment(cursor, seg_uuid)
-        segments_dict[seg_uuid] = get_lasttrkseg(cursor)
+        segments_dict[seg_uuid] = insert_segment(cursor, seg_uuid)
 
     return segments_dict
 
 
-def enterpoints(cursor, user, trkpts, file_uid, segments_dict):
+def geom_from_func(geom):
+    """
+    Return the SpatiaLite function converting geom into a geometry:
+    GeomFromWKB for WKB blobs, GeomFromText for WKT strings
+    """
+    if isinstance(geom, (bytes, bytearray)):
+        return "GeomFromWKB"
+    return "GeomFromText"
+
+
+def get_trkseg_uid(segments_dict, trkseg_uuid):
+    """
+    Look up the table uid of a segment uuid, -1 if it is unknown
+    """
+    if segments_dict is None:
+        return -1
+    return segments_dict.get(trkseg_uuid, -1)
+
+
+def get_existing_timestamps(cursor, user, firsttimestamp, lasttimestamp):
+    """
+    Return the set of trackpoint timestamps the user already has in the
+    database between firsttimestamp and lasttimestamp
+    """
+    sql = ("SELECT utctimestamp FROM trackpoints WHERE user_uid = ? "
+           "AND utctimestamp BETWEEN ? AND ?")
+    cursor.execute(sql, (user, str(firsttimestamp), str(lasttimestamp)))
+
+    return set(row[0] for row in cursor.fetchall())
+
+
+def find_duplicates(seen, timestamps):
+    """
+    Return the set of indices of timestamps which are in seen or occur
+    earlier in timestamps. seen is updated with the new timestamps.
+    """
+    duplicates = set()
+    for index, timestamp in enumerate(timestamps):
+        if timestamp in seen:
+            duplicates.add(index)
+        else:
+            seen.add(timestamp)
+
+    return duplicates
+
+
+def get_duplicates(cursor, user, timestamps):
+    """
+    Return the set of indices of the utctimestamp values timestamps which
+    would violate the (utctimestamp, user_uid) constraint. The existing
+    timestamps are queried between the lowest and the highest text, as
+    the constraint compares the texts. Points without time are stored as
+    'None' and looked up on their own.
+    """
+    texts = [timestamp for timestamp in timestamps if timestamp != 'None']
+    seen = set()
+    if texts:
+        seen = get_existing_timestamps(cursor, user, min(texts), max(texts))
+    if len(texts) < len(timestamps):
+        seen.update(get_existing_timestamps(cursor, user, 'None', 'None'))
+
+    return find_duplicates(seen, timestamps)
+
+
+def get_segment_duplicates(cursor, user, segment, timestamps=None):
+    """
+    Return the set of indices of the points of a TrackSegment which would
+    violate the (utctimestamp, user_uid) constraint. timestamps are the
+    segment's utctimestamp values if they are already known.
+    """
+    if timestamps is None:
+        timestamps = segment.get_timestamps()
+
+    return get_duplicates(cursor, user, timestamps)
+
+
+def enterpoints(cursor, user, trkpts, file_uid, segments_dict,
+                chunk_size=DEFAULT_CHUNK_SIZE):
     """
     Enters points in the spatially enabled 'trackpoints' table
 
@@ -104,44 +222,100 @@ def enterpoints(cursor, user, trkpts, file_uid, segments_dict):
     geom
 
     trkpts = trkseg_id, trksegpt_id, ele, time, course, speed, loc, geom
+
+    Points are written with executemany in chunks of chunk_size rows.
+    Points which would violate the (utctimestamp, user_uid) constraint
+    are left out. Returns the number of inserted points.
     """
-    for line in trkpts:
-        trkseg_uuid, trksegpt_id, ele, time, course, speed, loc, geom = line
+    sql = ("INSERT INTO trackpoints (trkseg_id, trksegpt_id, "
+           "ele, utctimestamp, course, speed, file_uid, user_uid, "
+           "citydef_uid, geom) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, "
+           "{0}(?, 4326))")
+    timestamps = [str(line[3]) for line in trkpts]
+    duplicates = get_duplicates(cursor, user, timestamps)
 
-        trkseg_uid = -1
-        if segments_dict is not None:
-            try:
-                trkseg_uid = segments_dict[trkseg_uuid]
-            except KeyError:
-                pass
+    def rows():
+        for index, line in enumerate(trkpts):
+            if index in duplicates:
+                continue
+            (trkseg_uuid, trksegpt_id, ele, time, course, speed, loc,
+             geom) = line
 
-        if loc == -1:
-            sql = ("INSERT INTO trackpoints (trkseg_id, trksegpt_id, "
-                   "ele, utctimestamp, course, speed, file_uid, user_uid, "
-                   "geom) VALUES ({0}, {1}, {2}, '{3}', {4}, {5}, {6}, {7}, "
-                   "GeomFromText('{8}', 4326))")
+            yield (get_trkseg_uid(segments_dict, trkseg_uuid), trksegpt_id,
+                   ele, timestamps[index], course, speed, file_uid, user,
+                   None if loc == -1 else loc, geom)
 
-            sql = sql.format(trkseg_uid, trksegpt_id, ele, time, course,
-                             speed, file_uid, user, geom)
+    num_inserted = 0
+    for chunk in helper.chunks(rows(), chunk_size):
+        cursor.executemany(sql.format(geom_from_func(chunk[0][-1])), chunk)
+        num_inserted += cursor.rowcount
+
+    if duplicates:
+        print("Not importing {0} duplicate points".format(len(duplicates)))
+
+    return num_inserted
+
+
+def enter_segment_points(cursor, user, segment, file_uid, trkseg_uid,
+                         skip=(), wkb=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                         timestamps=None):
+    """
+    Enters the points of a TrackSegment in the 'trackpoints' table,
+    straight from its columns and without building trackpoint lines.
+
+    Points whose index is in skip, the duplicates found by
+    get_segment_duplicates, are left out. Other points violating a
+    constraint raise an IntegrityError. Returns the number of inserted
+    points.
+    """
+    sql = ("INSERT INTO trackpoints (trkseg_id, trksegpt_id, "
+           "ele, utctimestamp, course, speed, file_uid, user_uid, "
+           "citydef_uid, geom) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, "
+           "{0}(?, 4326))").format(
+               "GeomFromWKB" if wkb else "GeomFromText")
+    if timestamps is None:
+        timestamps = segment.get_timestamps()
+
+    def rows():
+        columns = zip(segment.ele, timestamps, segment.course,
+                      segment.speed, segment.loc,
+                      segment.get_point_geometries(wkb))
+        for trksegpt_id, (ele, time, course, speed, loc, geom) in \
+                enumerate(columns):
+            if trksegpt_id in skip:
+                continue
+            yield (trkseg_uid, trksegpt_id, ele, time, course, speed,
+                   file_uid, user, None if loc == -1 else loc, geom)
 
-        else:
+    num_inserted = 0
+    for chunk in helper.chunks(rows(), chunk_size):
+        cursor.executemany(sql, chunk)
+        num_inserted += cursor.rowcount
+
+    return num_inserted
 
-            sql = ("INSERT INTO trackpoints (trkseg_id, trksegpt_id, "
-                   "ele, utctimestamp, course, speed, file_uid, user_uid, "
-                   "citydef_uid, geom)VALUES ({0}, {1}, {2}, '{3}', {4}, {5}, "
-                   "{6}, {7}, {8}, GeomFromText('{9}', 4326))")
 
-            sql = sql.format(trkseg_uid, trksegpt_id, ele, time, course,
-                             speed, file_uid, user, loc, geom)
+def enter_segment_line(cursor, user, segment, file_uid, trkseg_uid,
+                       wkb=False):
+    """
+    Enters the trackline of a TrackSegment in the 'tracklines' table.
+    Returns the number of inserted lines.
+    """
+    sql = ("INSERT INTO tracklines (trkseg_id, timestamp_start, "
+           "timestamp_end, length_m, time_sec, speed_kph, file_uid, "
+           "user_uid, geom) VALUES (?, ?, ?, ?, ?, ?, ?, ?, "
+           "{0}(?, 4326))").format(
+               "GeomFromWKB" if wkb else "GeomFromText")
+    cursor.execute(sql, (trkseg_uid, str(segment.timestamp_start),
+                         str(segment.timestamp_end), segment.length_m,
+                         segment.time_sec, segment.speed_kph, file_uid, user,
+                         segment.get_linestring(wkb)))
 
-        try:
-            cursor.execute(sql)
-        except spatialite_finder.spatialite.IntegrityError as err:
-            msg = "Not importing duplicate point from {0}: {1}"
-            print(msg.format(time, err))
+    return 1
 
 
-def enterlines(cursor, user, trklines, file_uid, segments_dict):
+def enterlines(cursor, user, trklines, file_uid, segments_dict,
+               chunk_size=DEFAULT_CHUNK_SIZE):
     """
     trackline columns: trkline_uid, trksegid_fm_trkpts, name, cmt,
     timestamp_start, timestamp_end, length_m, time_sec, speed_kph,
@@ -149,58 +323,62 @@ def enterlines(cursor, user, trklines, file_uid, segments_dict):
 
     trkline = [lastseg, timestamp_start, timestamp_end,
                length_m, time_sec, speed_kph, linestr]
+
+    Returns the number of inserted lines.
     """
-    for line in trklines:
-        (trkseg_uuid, timestamp_start, timestamp_end, length_m, time_sec,
-         speed_kph, linestr) = line
+    sql = ("INSERT INTO tracklines (trkseg_id, timestamp_start, "
+           "timestamp_end, length_m, time_sec, speed_kph, file_uid, "
+           "user_uid, geom) VALUES (?, ?, ?, ?, ?, ?, ?, ?, "
+           "{0}(?, 4326))")
 
-        trkseg_uid = -1
-        if segments_dict is not None:
-            try:
-                trkseg_uid = segments_dict[trkseg_uuid]
-            except KeyError:
-                pass
+    def rows():
+        for line in trklines:
+            (trkseg_uuid, timestamp_start, timestamp_end, length_m, time_sec,
+             speed_kph, linestr) = line
 
-        sql = ("INSERT INTO tracklines (trkseg_id, timestamp_start, "
-               "timestamp_end, length_m, time_sec, speed_kph, file_uid, "
-               "user_uid, geom) VALUES({0}, '{1}', '{2}', {3}, {4}, {5}, "
-               "{6}, {7}, GeomFromText('{8}', 4326))")
+            yield (get_trkseg_uid(segments_dict, trkseg_uuid),
+                   str(timestamp_start), str(timestamp_end), length_m,
+                   time_sec, speed_kph, file_uid, user, linestr)
 
-        sql = sql.format(trkseg_uid, timestamp_start, timestamp_end, length_m,
-                         time_sec, speed_kph, file_uid, user, linestr)
+    num_inserted = 0
+    for chunk in helper.chunks(rows(), chunk_size):
+        cursor.executemany(sql.format(geom_from_func(chunk[0][-1])), chunk)
+        num_inserted += len(chunk)
 
-        cursor.execute(sql)
+    return num_inserted
 
 
-def enterwaypoints(cursor, user, waypoints, file_uid):
-    """
+def enterwaypoints(cursor, user, waypoints, file_uid,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
     """
-    for wpt in waypoints:
-        wpt_name, wpt_ele, wpt_time, wpt_sym, wpt_loc, wpt_geom = wpt
-        if wpt_loc == -1:
-            sql = ("INSERT INTO waypoints (wpt_name, ele, utctimestamp, sym,"
-                   "file_uid, user_uid, geom) VALUES(\"{0}\", {1}, '{2}',"
-                   " \"{3}\", {4}, {5}, GeomFromText('{6}', 4326))")
+    Enters waypoints in the spatially enabled 'waypoints' table
 
-            sql = sql.format(wpt_name, wpt_ele, wpt_time, wpt_sym, file_uid,
-                             user, wpt_geom)
+    waypoint_line = name, ele, time, symbol, loc, geom
 
-        else:
+    Returns the number of inserted waypoints.
+    """
+    sql = ("INSERT INTO waypoints (wpt_name, ele, utctimestamp, sym, "
+           "file_uid, user_uid, citydef_uid, geom) VALUES "
+           "(?, ?, ?, ?, ?, ?, ?, {0}(?, 4326))")
 
-            sql = ("INSERT INTO waypoints (wpt_name, ele, utctimestamp, sym,"
-                   "file_uid, user_uid, citydef_uid, geom) VALUES "
-                   "(\"{0}\", {1}, '{2}', \"{3}\", {4}, {5}, {6},"
-                   " GeomFromText('{7}', 4326))")
+    def rows():
+        for wpt in waypoints:
+            wpt_name, wpt_ele, wpt_time, wpt_sym, wpt_loc, wpt_geom = wpt
 
-            sql = sql.format(wpt_name, wpt_ele, wpt_time, wpt_sym, file_uid,
-                             user, wpt_loc, wpt_geom)
+            yield (wpt_name, wpt_ele, str(wpt_time), wpt_sym, file_uid, user,
+                   None if wpt_loc == -1 else wpt_loc, wpt_geom)
 
-        cursor.execute(sql)
+    num_inserted = 0
+    for chunk in helper.chunks(rows(), chunk_size):
+        cursor.executemany(sql.format(geom_from_func(chunk[0][-1])), chunk)
+        num_inserted += len(chunk)
+
+    return num_inserted
 
 
 def insert_segment(cursor, seg_uuid):
     """
-    Insert a tracksegment into the database.
+    Insert a tracksegment into the database and return its trkseg_uid.
 
     Arguments:
     - `seg_uuid`: uuid of segment
@@ -209,6 +387,8 @@ def insert_segment(cursor, seg_uuid):
            "('{0}')").format(seg_uuid)
     cursor.execute(sql)
 
+    return cursor.lastrowid
+
 
 def get_location(cursor, lon, lat):
     """
@@ -227,12 +407,15 @@ def get_location(cursor, lon, lat):
     return loc_id
 
 
-def check_if_gpxfile_exists(cursor, filepath):
+def check_if_gpxfile_exists(cursor, filepath, md5hash=None):
     """
-    Checks if file is already in database.
+    Checks if file is already in database. The md5 hash of the file
+    is computed unless it is passed in.
     """
-    sql = "SELECT * FROM files WHERE md5hash = '{0}'".format(
-        helper.getmd5(filepath))
+    if md5hash is None:
+        md5hash = helper.getmd5(filepath)
+
+    sql = "SELECT * FROM files WHERE md5hash = '{0}'".format(md5hash)
 
     cursor.execute(sql)
 
@@ -246,6 +429,47 @@ def check_if_gpxfile_exists(cursor, filepath):
         return False
 
 
+def get_file_uid(cursor, md5hash):
+    """
+    Gets the file_uid of the file with the given md5 hash, -1 if the file
+    is not in the database.
+    """
+    sql = "SELECT file_uid FROM files WHERE md5hash = ?"
+    cursor.execute(sql, (md5hash,))
+
+    try:
+        file_uid = cursor.fetchone()[0]
+    except TypeError:
+        file_uid = -1
+    return file_uid
+
+
+def get_manifest(cursor):
+    """
+    Returns a dictionary mapping the absolute paths of imported files to
+    their (size, mtime_ns, inode) at import time. Only files which are
+    still in the files table are returned.
+    """
+    sql = ("SELECT import_manifest.filepath, import_manifest.size, "
+           "import_manifest.mtime_ns, import_manifest.inode "
+           "FROM import_manifest JOIN files "
+           "ON files.md5hash = import_manifest.md5hash")
+    cursor.execute(sql)
+
+    return dict((row[0], tuple(row[1:])) for row in cursor.fetchall())
+
+
+def enter_manifest(cursor, filepath, file_stat, md5hash, file_uid):
+    """
+    Records an imported file with its (size, mtime_ns, inode) in the
+    import manifest
+    """
+    size, mtime_ns, inode = file_stat
+    sql = ("INSERT OR REPLACE INTO import_manifest (filepath, size, "
+           "mtime_ns, inode, md5hash, file_uid) VALUES (?, ?, ?, ?, ?, ?)")
+    cursor.execute(sql, (filepath, size, mtime_ns, inode, md5hash, file_uid))
+
+
 def get_user_id(cursor, username):
     """
     Gets the user id for a given username string.
@@ -270,23 +494,36 @@ def insert_user(cursor, username):
     return get_user_id(cursor, username)
 
 
+def get_citydefs(cursor):
+    """
+    Return the citydef_uid and the polygons (see
+    helper.polygons_from_wkb) of every citydef
+    """
+    sql = ("SELECT citydef_uid, AsBinary(geom) FROM citydefs "
+           "WHERE geom IS NOT NULL ORDER BY citydef_uid")
+    cursor.execute(sql)
+    return [(citydef_uid, helper.polygons_from_wkb(geom))
+            for citydef_uid, geom in cursor.fetchall()]
+
+
 def get_location_func(cursor):
-    """Return the partial function for the location lookup"""
-    return partial(get_location, cursor)
+    """
+    Return the location lookup function. The citydefs are read once into
+    an in-memory spatial index (see locations.CitydefIndex), which is
+    called with lon, lat instead of querying the database for every point
+    like get_location.
+    """
+    return locations.CitydefIndex(get_citydefs(cursor))
 
 
 def update_locations(cursor, locations_list):
     """
     update the table with the list from getlocations
     """
-    num_updated = 0
-    for loc in locations_list:
-        sql = ("UPDATE trackpoints SET citydef_uid = {0} "
-               "WHERE trkpt_uid = {1}").format(loc[0], loc[1])
-        cursor.execute(sql)
-        num_updated += 1
+    sql = "UPDATE trackpoints SET citydef_uid = ? WHERE trkpt_uid = ?"
+    cursor.executemany(sql, locations_list)
 
-    return num_updated
+    return len(locations_list)
 
 
 def reset_cities(cursor):
@@ -297,18 +534,49 @@ def reset_cities(cursor):
     cursor.execute(sql)
 
 
+def get_cityid_trackpoint_pairs_sql(unknown_only, use_index=True):
+    """
+    Return the query of get_cityid_trackpoint_pairs. With use_index every
+    citydef only visits the trackpoints whose entry in the R*Tree of the
+    trackpoints spatial index lies inside the citydef's bounding box,
+    without it every citydef is tested against every trackpoint.
+    """
+    if use_index:
+        sql = ("SELECT MIN(citydefs.citydef_uid), trackpoints.trkpt_uid "
+               "FROM citydefs "
+               "CROSS JOIN idx_trackpoints_geom AS idx "
+               "CROSS JOIN trackpoints "
+               "WHERE citydefs.geom IS NOT NULL "
+               "AND idx.xmin <= MbrMaxX(citydefs.geom) "
+               "AND idx.xmax >= MbrMinX(citydefs.geom) "
+               "AND idx.ymin <= MbrMaxY(citydefs.geom) "
+               "AND idx.ymax >= MbrMinY(citydefs.geom) "
+               "AND trackpoints.trkpt_uid = idx.pkid AND ")
+    else:
+        sql = ("SELECT MIN(citydefs.citydef_uid), trackpoints.trkpt_uid "
+               "FROM citydefs, trackpoints WHERE ")
+
+    if unknown_only is True:
+        sql += "trackpoints.citydef_uid = 1 AND "
+
+    return sql + ("within(trackpoints.geom, citydefs.geom) "
+                  "GROUP BY trackpoints.trkpt_uid")
+
+
 def get_cityid_trackpoint_pairs(cursor, unknown_only):
     """
     Get a list of trackpoint ids and the location id of that
-    trackpoint from the citydefs table
-    """
-
-    sql = ("SELECT citydefs.citydef_uid, trackpoints.trkpt_uid "
-           "FROM citydefs, trackpoints "
-           "WHERE within(trackpoints.geom, citydefs.geom)")
-
-    if unknown_only is True:
-        sql += " AND trackpoints.citydef_uid = 1"
+    trackpoint from the citydefs table. Trackpoints in overlapping
+    citydefs get the lowest citydef_uid, as on import. The spatial index
+    of the trackpoints is used unless it is disabled, e.g. by an
+    interrupted bulk import, which leaves its R*Tree missing or stale.
+    """
+    connection = cursor.connection
+    use_index = (db_helper.check_if_table_exists(connection,
+                                                 "idx_trackpoints_geom") and
+                 "trackpoints" not in
+                 db_helper.get_disabled_spatial_indexes(connection))
+    sql = get_cityid_trackpoint_pairs_sql(unknown_only, use_index)
 
     results = cursor.execute(sql)
     locations_list = results.fetchall()
@@ -18,8 +18,8 @@ from . import spatialite_finder
 from . import get_data
 
 
-def create_new_db(db_path):
-    connection = spatialite_finder.get_connection(db_path)
+def create_new_db(db_path, profile=None):
+    connection = spatialite_finder.get_connection(db_path, profile)
     create_db_script = get_data("sql/create_db.sql")
 
     init_spatial_metadata(connection)
@@ -35,9 +35,29 @@ def create_new_db(db_path):
     except IOError as err:
         print(err)
 
+    create_manifest_table(connection)
+
     connection.close()
 
 
+def create_manifest_table(connection):
+    """
+    Creates the import_manifest table if it does not exist yet, so that
+    databases created by older versions get it on their next import
+    """
+    create_manifest_script = get_data("sql/create_manifest.sql")
+
+    try:
+        with open(create_manifest_script, 'r') as f:
+            try:
+                with connection:
+                    connection.executescript(f.read())
+            except spatialite_finder.spatialite.Error as err:
+                print('SQL Error: ' + str(err))
+    except IOError as err:
+        print(err)
+
+
 def init_spatial_metadata(connection):
     result = connection.execute('SELECT spatialite_version()')
     spatialite_version = result.fetchone()[0]
@@ -69,3 +89,45 @@ def check_if_table_exists(connection, table_name):
     sql += "WHERE name='{0}' and type='table'"
     cursor = connection.execute(sql.format(table_name))
     return True if int(cursor.fetchone()[0]) > 0 else False
+
+
+# geometry tables written by the importer
+SPATIAL_INDEX_TABLES = ['trackpoints', 'tracklines', 'waypoints']
+
+
+def get_disabled_spatial_indexes(connection):
+    """
+    Returns the importer tables whose spatial index is disabled, e.g. left
+    over from an interrupted bulk import
+    """
+    sql = ("SELECT f_table_name FROM geometry_columns "
+           "WHERE spatial_index_enabled = 0 AND f_geometry_column = 'geom'")
+    cursor = connection.execute(sql)
+    disabled = [row[0].lower() for row in cursor.fetchall()]
+
+    return [table for table in SPATIAL_INDEX_TABLES if table in disabled]
+
+
+def disable_spatial_indexes(connection):
+    """
+    Drops the spatial index triggers and R*Tree tables of the importer
+    tables. The disabled state is committed right away so that an
+    interrupted import can be recovered with rebuild_spatial_indexes.
+    """
+    for table in SPATIAL_INDEX_TABLES:
+        connection.execute("SELECT DisableSpatialIndex(?, 'geom')", (table,))
+        connection.execute(
+            'DROP TABLE IF EXISTS "idx_{0}_geom"'.format(table))
+    connection.commit()
+
+
+def rebuild_spatial_indexes(connection):
+    """
+    Recreates the disabled spatial indexes of the importer tables.
+    CreateSpatialIndex fills each R*Tree from all rows in one pass.
+    """
+    for table in get_disabled_spatial_indexes(connection):
+        connection.execute(
+            'DROP TABLE IF EXISTS "idx_{0}_geom"'.format(table))
+        connection.execute("SELECT CreateSpatialIndex(?, 'geom')", (table,))
+    connection.commit()
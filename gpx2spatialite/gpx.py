@@ -29,27 +29,448 @@ except ImportError:
     print('*' * 48)
     sys.exit(2)
 import uuid
+from array import array
+from xml.etree import ElementTree
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+from gpxpy import gpxfield
 from . import helper
+from . import sources
+from .segment import TrackSegment, parse_time
+
+
+PARSERS = ['gpxpy', 'stream', 'lxml']
+
+
+_NAN = float('nan')
+
 
+class GPXParseError(Exception):
+    """Raised by the streaming parser for malformed gpx files"""
 
-def get_gpx_file(file_path):
-    """Return GPX file."""
+
+def get_gpx_file(file_path, archives=None):
+    """Return GPX file, None if it can not be read or parsed."""
     try:
-        with open(file_path) as gpx_file:
+        with sources.open_source(file_path, archives) as gpx_file:
             try:
                 gpx_obj = gpxpy.parse(gpx_file)
                 return gpx_obj
             except Exception as e:
                 msg = "GPXException ({0}) for {1}: {2}."
                 print(msg.format(type(e), file_path, e))
-    except IOError as err:
-        print(err)
-        sys.exit(2)
+    except sources.READ_ERRORS as err:
+        print("Unable to read {0}: {1}".format(file_path, err))
+
+
+def get_parser(parser):
+    """
+    Return the parser backend used for the parser name, which is 'gpxpy'
+    for 'lxml' if lxml is not installed
+    """
+    if parser not in PARSERS:
+        raise ValueError("Unknown parser: {0}".format(parser))
+    if parser == 'lxml' and lxml_etree is None:
+        return 'gpxpy'
+    return parser
+
+
+def iter_gpxpy_items(gpx_obj):
+    """
+    Yield the contents of a gpxpy object in document order as
+    ('trkseg', points) and ('wpt', waypoint) items.
+
+    point = lat, lon, ele, time, speed
+    waypoint = lat, lon, ele, time, name, symbol
+    """
+    for wpt in gpx_obj.waypoints:
+        yield 'wpt', (wpt.latitude, wpt.longitude, wpt.elevation, wpt.time,
+                      wpt.name, wpt.symbol)
+
+    for track in gpx_obj.tracks:
+        for segment in track.segments:
+            yield 'trkseg', [(point.latitude, point.longitude,
+                              point.elevation, point.time, point.speed)
+                             for point in segment.points]
+
+
+def iterparse_items(file_path, parser='stream', archives=None):
+    """
+    Stream the gpx file with ElementTree.iterparse (or lxml.etree.iterparse
+    if parser is 'lxml') and yield the same items as iter_gpxpy_items
+    without building a gpxpy object tree. Only the points of the current
+    segment are kept in memory.
+
+    Values are converted with the gpxpy field converters, so the results
+    are identical to the gpxpy parser. Only the times of track points are
+    passed on as text, TrackSegment converts them without datetimes.
+    Raises GPXParseError for malformed files and one of sources.READ_ERRORS
+    for files which can not be read. Archive members are read through the
+    sources.ArchiveReader archives if it is not None.
+    """
+    if parser == 'lxml':
+        parse_source = _lxml_iterparse_source
+    else:
+        parse_source = _iterparse_source
+    try:
+        for item in _iterparse_items(file_path, parse_source, archives):
+            yield item
+    except sources.READ_ERRORS:
+        raise
+    except Exception as e:
+        raise GPXParseError("{0}: {1}".format(type(e).__name__, e))
+
+
+def _iterparse_items(file_path, parse_source, archives):
+    """
+    Generator doing the actual work of iterparse_items
+    """
+    with sources.open_source(file_path, archives) as source:
+        for item in parse_source(source):
+            yield item
+
+
+def _iterparse_source(source):
+    """
+    Parse the items of an open gpx file with ElementTree
+    """
+    ns = ''
+    read_speed = True
+    depth = 0
+    root = None
+    seg_points = None
+    for event, elem in ElementTree.iterparse(source,
+                                             events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = elem
+                if elem.tag.startswith('{'):
+                    ns = elem.tag[:elem.tag.index('}') + 1]
+                # gpxpy reads <speed> of track points only for gpx 1.0
+                read_speed = elem.get('version') != '1.1'
+            elif elem.tag == ns + 'trkseg':
+                seg_points = []
+            continue
+
+        depth -= 1
+        if elem.tag == ns + 'trkpt' and seg_points is not None:
+            values = _child_values(elem, ns, ('ele', 'time', 'speed'))
+            seg_points.append((
+                _parse_coordinate(elem, 'lat'),
+                _parse_coordinate(elem, 'lon'),
+                gpxfield.FLOAT_TYPE.from_string(values['ele']),
+                values['time'],
+                gpxfield.FLOAT_TYPE.from_string(values['speed'])
+                if read_speed else None))
+            elem.clear()
+        elif elem.tag == ns + 'trkseg':
+            yield 'trkseg', seg_points
+            seg_points = None
+            elem.clear()
+        elif elem.tag == ns + 'wpt' and depth == 1:
+            values = _child_values(elem, ns, ('ele', 'time', 'name', 'sym'))
+            yield 'wpt', (_parse_coordinate(elem, 'lat'),
+                          _parse_coordinate(elem, 'lon'),
+                          gpxfield.FLOAT_TYPE.from_string(values['ele']),
+                          gpxfield.TIME_TYPE.from_string(values['time']),
+                          values['name'], values['sym'])
+
+        if depth == 1:
+            # drop finished top level elements (wpt, trk, rte, ...)
+            root.remove(elem)
+
+
+def _lxml_iterparse_source(source):
+    """
+    Parse the items of an open gpx file with lxml. Only the end events of
+    trkpt, trkseg, wpt, trk and rte elements reach Python.
+    """
+    ns = None
+    read_speed = True
+    seg_points = []
+    for event, elem in lxml_etree.iterparse(
+            source, events=('end',),
+            tag=('{*}trkpt', '{*}trkseg', '{*}wpt', '{*}trk', '{*}rte')):
+        if ns is None:
+            root = elem.getroottree().getroot()
+            ns = root.tag[:root.tag.index('}') + 1] \
+                if root.tag.startswith('{') else ''
+            # gpxpy reads <speed> of track points only for gpx 1.0
+            read_speed = root.get('version') != '1.1'
+            trkpt_tag = ns + 'trkpt'
+            trkseg_tag = ns + 'trkseg'
+            wpt_tag = ns + 'wpt'
+
+        parent = elem.getparent()
+        if elem.tag == trkpt_tag:
+            if parent.tag == trkseg_tag:
+                values = _child_values(elem, ns, ('ele', 'time', 'speed'))
+                seg_points.append((
+                    _parse_coordinate(elem, 'lat'),
+                    _parse_coordinate(elem, 'lon'),
+                    gpxfield.FLOAT_TYPE.from_string(values['ele']),
+                    values['time'],
+                    gpxfield.FLOAT_TYPE.from_string(values['speed'])
+                    if read_speed else None))
+            # drop the finished points of the segment
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+            continue
+        elif elem.tag == trkseg_tag:
+            yield 'trkseg', seg_points
+            seg_points = []
+        elif elem.tag == wpt_tag and parent is root:
+            values = _child_values(elem, ns, ('ele', 'time', 'name', 'sym'))
+            yield 'wpt', (_parse_coordinate(elem, 'lat'),
+                          _parse_coordinate(elem, 'lon'),
+                          gpxfield.FLOAT_TYPE.from_string(values['ele']),
+                          gpxfield.TIME_TYPE.from_string(values['time']),
+                          values['name'], values['sym'])
+
+        elem.clear()
+        if parent is not None:
+            # drop finished segments and top level elements (metadata,
+            # wpt, rte, trk, ...) as _iterparse_source does
+            while elem.getprevious() is not None:
+                del parent[0]
+            parent.remove(elem)
+
+
+def _child_values(elem, ns, tags):
+    """
+    Return a dictionary with the text of the first direct child of elem
+    for each of the given tags, None for missing children
+    """
+    values = dict.fromkeys(tags)
+    for child in elem:
+        if not isinstance(child.tag, str):
+            # comments and processing instructions of lxml
+            continue
+        tag = child.tag[len(ns):] if child.tag.startswith(ns) else None
+        if tag in values and values[tag] is None:
+            values[tag] = child.text
+    return values
+
+
+def _parse_coordinate(elem, attribute):
+    """
+    Parse the mandatory lat or lon attribute of a point element
+    """
+    value = elem.get(attribute)
+    if value is None:
+        raise GPXParseError("{0} is mandatory in {1}".format(
+            attribute, elem.tag))
+    return gpxfield.FLOAT_TYPE.from_string(value)
+
+
+def extract_segment(points, get_loc_func=None):
+    """
+    Turn the points of a segment into a columnar TrackSegment with course,
+    speed, location and the statistics of the segment's trackline
+    """
+    segment = TrackSegment(uuid.uuid4())
+    eles = array('d')
+    for lat, lon, ele, time, speed in points:
+        segment.append(lon, lat, ele or 0, time, speed or 0, 0)
+        if ele is None:
+            print("No elevation recorded for "
+                  "{0} - assuming 0".format(segment.get_time(-1)))
+            eles.append(_NAN)
+        else:
+            eles.append(ele)
+
+    # missing speeds, length and duration in one pass over the columns
+    segment.speed, length_m, time_sec = helper.get_segment_metrics(
+        segment.lat, segment.lon, eles, segment.time, segment.speed)
+
+    # the first point has no course
+    segment.course[1:] = helper.get_courses(segment.lat, segment.lon)
 
+    if get_loc_func:
+        segment.locate(get_loc_func)
 
-def extractpoints(filepath, get_loc_func=None, skip_wpts=False):
+    try:
+        speed_kph = (length_m / time_sec) * 3.6
+    except ZeroDivisionError:
+        speed_kph = 0.0
+
+    segment.timestamp_start, segment.timestamp_end = \
+        segment.get_time_bounds()
+    segment.length_m = length_m
+    segment.time_sec = time_sec
+    segment.speed_kph = speed_kph
+
+    return segment
+
+
+def _parse_point_time(point):
+    """
+    Return the time of a point as datetime, streaming parsers pass the
+    text of the time element
+    """
+    time = point[3]
+    if isinstance(time, str):
+        return parse_time(time)
+    return time
+
+
+def extract_waypoint(wpt, get_loc_func=None, wkb=False):
+    """
+    Turn a waypoint into a waypoint line (see extractpoints)
+    """
+    wpt_lat, wpt_lon, wpt_ele, wpt_time, wpt_name, wpt_symbol = wpt
+    if wkb:
+        wpt_geom_str = helper.point_wkb(wpt_lon, wpt_lat)
+    else:
+        wpt_geom_str = "Point({0} {1})".format(wpt_lon, wpt_lat)
+
+    if wpt_ele is None:
+        print("No elevation recorded for "
+              "{0} - assuming 0".format(wpt_time))
+        wpt_ele = 0
+
+    if get_loc_func:
+        wpt_loc = get_loc_func(wpt_lon, wpt_lat)
+    else:
+        wpt_loc = -1
+
+    return [wpt_name, wpt_ele, wpt_time, wpt_symbol, wpt_loc, wpt_geom_str]
+
+
+def iterextract(filepath, get_loc_func=None, skip_wpts=False, wkb=False,
+                parser='gpxpy', cache=None, md5hash=None, archives=None):
+    """
+    parse the gpx file and yield its contents one segment at a time, so
+    that a segment can be written before the next one is parsed
+
+    Yields ('segment', segment) with a TrackSegment for every segment
+    with at least two points and ('waypoint', wptline) for every waypoint
+    (see extractpoints for the line format). The last item is always
+    ('timestamps', (firsttimestamp, lasttimestamp)). Timestamps of 0, 0
+    mean the file could not be read or parsed and everything yielded
+    before has to be discarded.
+
+    If cache is a cache.ParseCache, a file whose md5 hash (computed if
+    md5hash is None) is in the cache is read from the cache instead of
+    being parsed, other files are added to the cache while they are
+    parsed. Archive members are read through the sources.ArchiveReader
+    archives if it is not None.
+    """
+    writer = None
+    if cache is not None:
+        if md5hash is None:
+            md5hash = helper.getmd5(filepath, archives)
+        if md5hash:
+            records = cache.load(md5hash)
+            if records is not None:
+                for item in _extract_records(records, get_loc_func,
+                                             skip_wpts, wkb):
+                    yield item
+                return
+            writer = cache.writer(md5hash)
+
+    try:
+        for item in _iterextract(filepath, get_loc_func, skip_wpts, wkb,
+                                 parser, writer, archives):
+            yield item
+    finally:
+        # parse errors and unfinished parses are not cached
+        if writer is not None:
+            writer.discard()
+
+
+def _iterextract(filepath, get_loc_func, skip_wpts, wkb, parser, writer,
+                 archives):
+    """
+    Parse the gpx file for iterextract, adding its contents to the cache
+    entry writer if it is not None
+    """
+    parser = get_parser(parser)
+    if parser != 'gpxpy':
+        items = iterparse_items(filepath, parser, archives)
+    else:
+        gpx_obj = get_gpx_file(filepath, archives)
+        if gpx_obj is None:
+            yield 'timestamps', (0, 0)
+            return
+        items = iter_gpxpy_items(gpx_obj)
+
+    firsttimestamp = None
+    lasttimestamp = None
+
+    try:
+        for kind, item in items:
+            if kind == 'wpt':
+                if writer is not None:
+                    writer.add_waypoint(item)
+                if not skip_wpts:
+                    yield 'waypoint', extract_waypoint(item, get_loc_func,
+                                                       wkb)
+                continue
+
+            if len(item) > 1:
+                segment = extract_segment(item, get_loc_func)
+                timestamp_start = segment.timestamp_start
+                timestamp_end = segment.timestamp_end
+            else:
+                segment = None
+                timestamp_start = timestamp_end = \
+                    _parse_point_time(item[0]) if item else None
+
+            if not firsttimestamp and timestamp_start:
+                firsttimestamp = timestamp_start
+            if timestamp_end:
+                lasttimestamp = timestamp_end
+
+            if segment is not None:
+                if writer is not None:
+                    writer.add_segment(segment)
+                yield 'segment', segment
+            else:
+                print("skipping segment with < 2 points")
+    except sources.READ_ERRORS as err:
+        print("Unable to read {0}: {1}".format(filepath, err))
+        firsttimestamp, lasttimestamp = 0, 0
+    except GPXParseError as e:
+        msg = "GPXException ({0}) for {1}: {2}."
+        print(msg.format(type(e), filepath, e))
+        firsttimestamp, lasttimestamp = 0, 0
+
+    if writer is not None and firsttimestamp != 0 and lasttimestamp != 0:
+        writer.commit(firsttimestamp, lasttimestamp)
+
+    yield 'timestamps', (firsttimestamp, lasttimestamp)
+
+
+def _extract_records(records, get_loc_func, skip_wpts, wkb):
+    """
+    Turn the records of a cache entry into iterextract items
+    """
+    for kind, value in records:
+        if kind == 'segment':
+            if get_loc_func:
+                value.locate(get_loc_func)
+            yield kind, value
+        elif kind == 'wpt':
+            if not skip_wpts:
+                yield 'waypoint', extract_waypoint(value, get_loc_func, wkb)
+        else:
+            yield kind, value
+
+
+def extractpoints(filepath, get_loc_func=None, skip_wpts=False, wkb=False,
+                  parser='gpxpy', cache=None, md5hash=None):
     """
-    parse the gpx file using gpxpy and return a list of lines
+    parse the gpx file and return a list of lines
+
+    The file is parsed with gpxpy or, if parser is 'stream' or 'lxml',
+    with the streaming parser of iterparse_items. If wkb is True geometries are
+    encoded as WKB blobs, otherwise as WKT strings. Files in the parse
+    cache are read from the cache (see iterextract).
 
     line = trkseg_id, trksegpt_id, ele, time, course, speed, loc, geom
 
@@ -69,102 +490,18 @@ def extractpoints(filepath, get_loc_func=None, skip_wpts=False):
     wpts = []
     segs = []
 
-    gpx_obj = get_gpx_file(filepath)
-    if gpx_obj is None:
-        return trkpts, trklines, 0, 0, wpts, segs
-
-    firsttimestamp, lasttimestamp = gpx_obj.get_time_bounds()
-
-    for track in gpx_obj.tracks:
-        for segment in track.segments:
-            if segment.get_points_no() > 1:
-                seg_uuid = uuid.uuid4()
-                segs.append(seg_uuid)
-                trksegpt_id = 0
-                pts_strs = []
-                lastpoint = None
-                for point in segment.points:
-                    lat = point.latitude
-                    lon = point.longitude
-                    geom_str = "Point({0} {1})".format(lon, lat)
-
-                    pts_str = "{0} {1}".format(lon, lat)
-                    pts_strs.append(pts_str)
-
-                    time = point.time
-                    ele = point.elevation
-                    if ele is None:
-                        print("No elevation recorded for "
-                              "{0} - assuming 0".format(time))
-                        ele = 0
-                    speed = point.speed
-
-                    if lastpoint:
-                        lon1 = lastpoint.longitude
-                        lat1 = lastpoint.latitude
-                        course = helper.get_course(lat1, lon1, lat, lon)
-                        if not speed:
-                            speed = point.speed_between(lastpoint)
-                            if speed is None:
-                                speed = 0
-                    else:
-                        course = 0
-                        if not speed:
-                            speed = 0
-
-                    if get_loc_func:
-                        loc = get_loc_func(lon, lat)
-                    else:
-                        loc = -1
-
-                    ptline = [seg_uuid, trksegpt_id, ele, time,
-                              course, speed, loc, geom_str]
-
-                    trkpts.append(ptline)
-                    trksegpt_id += 1
-                    lastpoint = point
-
-                timestamp_start, timestamp_end \
-                    = segment.get_time_bounds()
-                length_m = segment.length_2d()
-                time_sec = segment.get_duration()
-                try:
-                    speed_kph = (length_m / time_sec) * 3.6
-                except ZeroDivisionError:
-                    speed_kph = 0.0
-                linestr = "LINESTRING("
-                linestr += ",".join(pts_strs)
-                linestr += ")"
-                trkline = [seg_uuid, timestamp_start, timestamp_end,
-                           length_m, time_sec, speed_kph, linestr]
-                trklines.append(trkline)
-            else:
-                print("skipping segment with < 2 points")
-
-    if not skip_wpts:
-        for wpt in gpx_obj.waypoints:
-            wptline = []
-            wpt_lat = wpt.latitude
-            wpt_lon = wpt.longitude
-            wpt_geom_str = "Point({0} {1})".format(wpt_lon, wpt_lat)
-
-            wpt_name = wpt.name
-            wpt_symbol = wpt.symbol
-            wpt_time = wpt.time
-            wpt_ele = wpt.elevation
-            if wpt_ele is None:
-                print("No elevation recorded for "
-                      "{0} - assuming 0".format(wpt_time))
-                wpt_ele = 0
-
-            if get_loc_func:
-                wpt_loc = get_loc_func(wpt_lon, wpt_lat)
-            else:
-                wpt_loc = -1
-
-            wptline = [wpt_name, wpt_ele, wpt_time, wpt_symbol,
-                       wpt_loc, wpt_geom_str]
+    for kind, value in iterextract(filepath, get_loc_func, skip_wpts, wkb,
+                                   parser, cache, md5hash):
+        if kind == 'segment':
+            segs.append(value.seg_uuid)
+            trkpts.extend(value.trackpoints(wkb))
+            trklines.append(value.trackline(wkb))
+        elif kind == 'waypoint':
+            wpts.append(value)
+        else:
+            firsttimestamp, lasttimestamp = value
 
-            wpts.append(wptline)
+    if firsttimestamp == 0 or lasttimestamp == 0:
+        return [], [], 0, 0, [], []
 
     return trkpts, trklines, firsttimestamp, lasttimestamp, wpts, segs
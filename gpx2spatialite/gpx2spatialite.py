@@ -21,12 +21,27 @@
 import sys
 import os.path
 import argparse
-from datetime import datetime
+import multiprocessing
+from collections import deque
+from datetime import datetime, timedelta
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    # accepts the native str printed in Python 2, unlike io.StringIO
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 from . import spatialite_finder
 from . import db
 from . import db_helper
 from . import gpx
 from . import cmdline
+from . import cache
+from . import locations
+from . import helper
+from . import sources
 from . import get_data, __version__
 
 
@@ -36,10 +51,11 @@ def create_db(args_dict):
     custom_citydefs = args_dict['custom_citydefs']
     no_citydefs = args_dict['no_citydefs']
     exec_script = args_dict['execute_script']
+    profile = args_dict['profile']
 
-    db_helper.create_new_db(new_db)
+    db_helper.create_new_db(new_db, profile)
 
-    conn = spatialite_finder.get_connection(new_db)
+    conn = spatialite_finder.get_connection(new_db, profile)
 
     def print_file_not_exists(file_name):
         print("'{0}' does not exist".format(file_name))
@@ -82,10 +98,16 @@ def citydefs(args_dict):
     import_file = args_dict['import_citydefs']
     export_file = args_dict['export_citydefs']
     quiet = args_dict['quiet']
+    profile = args_dict['profile']
 
     cmdline.set_print_verbose(not quiet)
 
-    conn = spatialite_finder.get_connection(dbpath)
+    if import_file and profile in spatialite_finder.READONLY_PROFILES:
+        print("Can not import citydefs with the read only profile "
+              "{0}".format(profile))
+        sys.exit(2)
+
+    conn = spatialite_finder.get_connection(dbpath, profile)
     cursor = conn.cursor()
 
     if export_file:
@@ -114,13 +136,14 @@ def update_locs(args_dict):
     dbpath = os.path.expanduser(args_dict['dbpath'])
     all_locs = args_dict['all_locs']
     quiet = args_dict['quiet']
+    profile = args_dict['profile']
 
     cmdline.set_print_verbose(not quiet)
 
     # -------------------------------------------------------------------------
     starttime = datetime.now()
     # -------------------------------------------------------------------------
-    conn = spatialite_finder.get_connection(dbpath)
+    conn = spatialite_finder.get_connection(dbpath, profile)
     cursor = conn.cursor()
 
     # -------------------------------------------------------------------------
@@ -160,6 +183,414 @@ def update_locs(args_dict):
     cmdline.print_cmdline("*" * 48)
 
 
+def import_file(cursor, filepath, file_stat, md5hash, items, userid,
+                args_dict):
+    """
+    Enter the contents of a single gpx file into the database.
+
+    items are the gpx.iterextract items of the file, either still being
+    parsed or parsed by a worker process (see parse_files). The file is
+    written inside a savepoint, so a file failing to import is rolled
+    back without touching the other files of the current transaction.
+    Database errors skip the file, other exceptions are raised again
+    after the rollback. Returns the number of entered trackpoints or None
+    if the file was not imported.
+    """
+    chunk_size = args_dict['chunk_size']
+    wkb = args_dict['wkb']
+
+    # -------------------------------------------------------------------------
+
+    file_uid = db.get_file_uid(cursor, md5hash)
+    if file_uid != -1:
+        cmdline.print_cmdline(
+            "File {0} already in database".format(filepath))
+        db.enter_manifest(cursor, filepath, file_stat, md5hash, file_uid)
+        return None
+
+    # -------------------------------------------------------------------------
+
+    starttime = datetime.now()
+    cmdline.print_cmdline("#" * 48)
+    cmdline.print_cmdline("Importing points from {0}".format(filepath))
+
+    # -------------------------------------------------------------------------
+
+    # segments are entered as soon as they are parsed, the file gets its
+    # timestamps once the whole file has been read
+    db.savepoint(cursor, "import_file")
+    try:
+        file_uid = db.enterfile(filepath, cursor, userid, None, None,
+                                md5hash)
+
+        num_points = 0
+        num_rows = 0
+        num_duplicates = 0
+        db_duration = timedelta(0)
+        wpts = []
+        for kind, value in items:
+            if kind == 'waypoint':
+                wpts.append(value)
+                continue
+            elif kind == 'timestamps':
+                firsttimestamp, lasttimestamp = value
+                continue
+
+            db_starttime = datetime.now()
+
+            segment = value
+            trkseg_uid = db.insert_segment(cursor, segment.seg_uuid)
+
+            timestamps = segment.get_timestamps()
+            duplicates = db.get_segment_duplicates(cursor, userid, segment,
+                                                   timestamps)
+            num_duplicates += len(duplicates)
+
+            # print "Entering points into database"
+            num_seg_points = db.enter_segment_points(
+                cursor, userid, segment, file_uid, trkseg_uid, duplicates,
+                wkb, chunk_size, timestamps)
+            num_points += num_seg_points
+
+            # print "Entering lines into database"
+            num_rows += num_seg_points + db.enter_segment_line(
+                cursor, userid, segment, file_uid, trkseg_uid, wkb)
+
+            db_duration += datetime.now() - db_starttime
+
+        # ---------------------------------------------------------------------
+
+        msg = "File first timestamp: {0}, last timestamp: {1}"
+        cmdline.print_cmdline(msg.format(firsttimestamp, lasttimestamp))
+
+        if firsttimestamp == 0 or lasttimestamp == 0:
+            db.rollback_to_savepoint(cursor, "import_file")
+            cmdline.print_cmdline("Skipping importing {0}.".format(filepath))
+            return None
+
+        # ---------------------------------------------------------------------
+
+        db_starttime = datetime.now()
+
+        # print entering waypoints into database
+        num_rows += db.enterwaypoints(cursor, userid, wpts, file_uid,
+                                      chunk_size)
+
+        db.update_file_timestamps(cursor, file_uid, firsttimestamp,
+                                  lasttimestamp)
+        db.enter_manifest(cursor, filepath, file_stat, md5hash, file_uid)
+
+        db_duration += datetime.now() - db_starttime
+    except spatialite_finder.spatialite.Error as err:
+        db.rollback_to_savepoint(cursor, "import_file")
+        print("Rolled back importing {0}: {1}".format(filepath, err))
+        return None
+    except BaseException:
+        # the import stops, the files before this one are kept
+        db.rollback_to_savepoint(cursor, "import_file")
+        raise
+
+    db.release_savepoint(cursor, "import_file")
+
+    # -------------------------------------------------------------------------
+
+    if num_duplicates > 0:
+        cmdline.print_cmdline(
+            "Not importing {0} duplicate points".format(num_duplicates))
+
+    msg = "\nImporting {0} points and {1} waypoints from gpx file took {2}"
+    cmdline.print_cmdline(
+        msg.format(num_points, len(wpts), datetime.now() - starttime))
+
+    msg = "Entering {0} rows into database took {1} ({2:.0f} rows/sec)"
+    cmdline.print_cmdline(msg.format(
+        num_rows, db_duration,
+        helper.rows_per_second(num_rows, db_duration)))
+
+    return num_points
+
+
+def get_cache(args_dict):
+    """
+    Return the parse cache set by the import options, None if there is
+    none
+    """
+    if args_dict['cache_dir'] is None:
+        return None
+    return cache.ParseCache(os.path.expanduser(args_dict['cache_dir']),
+                            args_dict['cache_size'] * 1024 * 1024)
+
+
+def read_files(filepaths, manifest, get_loc_func, args_dict):
+    """
+    Hash and parse the gpx files one after another. Yields
+    (filepath, file_stat, md5hash, items) for every file, where items are
+    the gpx.iterextract items of the file, parsed while they are entered.
+    Files recorded unchanged in the manifest dictionary are skipped
+    without hashing them.
+    """
+    parse_cache = get_cache(args_dict)
+    with sources.ArchiveReader() as archives:
+        for filepath in filepaths:
+            filepath = os.path.abspath(filepath)
+            file_stat = helper.get_file_stat(filepath)
+            if manifest.get(filepath) == file_stat:
+                cmdline.print_cmdline(
+                    "File {0} unchanged since last import".format(filepath))
+                continue
+
+            md5hash = helper.getmd5(filepath, archives)
+            items = gpx.iterextract(filepath, get_loc_func, False,
+                                    args_dict['wkb'], args_dict['parser'],
+                                    parse_cache, md5hash, archives)
+            yield filepath, file_stat, md5hash, items
+
+
+# a worker process of parse_files sends the items of a file in chunks of
+# about CHUNK_POINTS points and is at most MAX_CHUNKS_AHEAD chunks ahead of
+# the importing process
+CHUNK_POINTS = 50000
+MAX_CHUNKS_AHEAD = 2
+
+# the location lookup and the sources.ArchiveReader of a worker process
+# of parse_files
+_worker_loc_func = [None]
+_worker_archives = [None]
+
+
+def init_worker(dbpath, skip_locs, quiet):
+    """
+    Set up a worker process of parse_files. Locations are looked up over
+    a read only connection of the worker, all writes are done by the
+    importing process.
+    """
+    cmdline.set_print_verbose(not quiet)
+    _worker_archives[0] = sources.ArchiveReader()
+    if not skip_locs:
+        conn = spatialite_finder.get_connection(dbpath, 'readonly-analytics')
+        _worker_loc_func[0] = db.get_location_func(conn.cursor())
+
+
+def run_worker(tasks, results, dbpath, skip_locs, quiet, parse_cache):
+    """
+    Main loop of a worker process of parse_files, parsing the files of
+    the queue tasks until it gets None
+    """
+    init_worker(dbpath, skip_locs, quiet)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        parse_file(results, *(task + (parse_cache,)))
+
+
+def parse_file(results, filepath, wkb, parser, parse_cache):
+    """
+    Hash and parse a gpx file in a worker process and send it over the
+    queue results as (kind, value, output) messages, where output are the
+    messages printed since the last message:
+
+    ('hash', md5hash, output) first, then ('items', items, output) with
+    chunks of the gpx.iterextract items of about CHUNK_POINTS points and
+    finally ('end', (exit_status, loc_stats), output) with the exit status
+    if parsing called sys.exit, otherwise None, and the location lookup
+    statistics of the file (None with skip_locs). Other exceptions end
+    the file with ('error', message, output).
+    """
+    get_loc_func = _worker_loc_func[0]
+    if get_loc_func is not None:
+        get_loc_func.reset_stats()
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+
+    def send(kind, value):
+        output = sys.stdout.getvalue()
+        sys.stdout.seek(0)
+        sys.stdout.truncate()
+        results.put((kind, value, output))
+
+    try:
+        md5hash = helper.getmd5(filepath, _worker_archives[0])
+        send('hash', md5hash)
+
+        exit_status = None
+        chunk = []
+        num_points = 0
+        try:
+            for item in gpx.iterextract(filepath, get_loc_func, False, wkb,
+                                        parser, parse_cache, md5hash,
+                                        _worker_archives[0]):
+                chunk.append(item)
+                num_points += len(item[1]) if item[0] == 'segment' else 1
+                if num_points >= CHUNK_POINTS:
+                    send('items', chunk)
+                    chunk = []
+                    num_points = 0
+        except SystemExit as err:
+            exit_status = err.code
+        send('items', chunk)
+
+        loc_stats = None
+        if get_loc_func is not None:
+            loc_stats = dict(get_loc_func.stats)
+        send('end', (exit_status, loc_stats))
+    except Exception as err:
+        msg = "GPXException ({0}) for {1}: {2}."
+        send('error', msg.format(type(err), filepath, err))
+    finally:
+        sys.stdout = stdout
+
+
+def get_message(worker):
+    """
+    Return the next message of the (process, tasks, results) worker of
+    parse_files. Raises RuntimeError if the worker process died.
+    """
+    process, tasks, results = worker
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError("Worker process exited with code {0}"
+                                   .format(process.exitcode))
+
+
+def receive_items(worker, output, file_state, loc_stats=None):
+    """
+    Yield the items of a file sent by a worker process (see parse_file)
+    while they arrive, printing the messages the
+    worker printed while parsing them. The location lookup statistics of
+    the file are added to loc_stats. file_state['done'] is set once the
+    last message of the file is read.
+
+    A file the worker failed to parse ends with the timestamps (0, 0),
+    like a malformed file in gpx.iterextract, so import_file rolls it
+    back and the import goes on with the next file.
+    """
+    sys.stdout.write(output)
+    while True:
+        kind, value, output = get_message(worker)
+        sys.stdout.write(output)
+        if kind == 'items':
+            for item in value:
+                yield item
+            continue
+
+        file_state['done'] = True
+        if kind == 'error':
+            print(value)
+            yield 'timestamps', (0, 0)
+            return
+        exit_status, file_loc_stats = value
+        if exit_status is not None:
+            sys.exit(exit_status)
+        if loc_stats is not None and file_loc_stats is not None:
+            for key, stat in file_loc_stats.items():
+                loc_stats[key] = loc_stats.get(key, 0) + stat
+        return
+
+
+def skip_items(worker):
+    """
+    Read and drop the remaining messages of a file sent by a worker
+    process whose items were not entered
+    """
+    while get_message(worker)[0] == 'items':
+        pass
+
+
+def parse_files(filepaths, manifest, args_dict, loc_stats=None):
+    """
+    Hash and parse the gpx files in args_dict['jobs'] worker processes.
+    Yields the same tuples as read_files, in the order of filepaths
+    whatever the number of workers, so the files are entered by the
+    importing process alone and get the same file_uids as with a single
+    process. The location lookup statistics of the entered files are
+    added up in the loc_stats dictionary.
+
+    Files are handed to the workers in turn and their items are sent back
+    in chunks while they are parsed. Every worker has its own bounded
+    result queue, so at most MAX_CHUNKS_AHEAD chunks per worker are held
+    ahead of the importing process, however large the files are.
+    """
+    jobs = args_dict['jobs']
+    parse_cache = get_cache(args_dict)
+    workers = []
+    for index in range(jobs):
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue(MAX_CHUNKS_AHEAD)
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(tasks, results, os.path.expanduser(args_dict['dbpath']),
+                  args_dict['skip_locs'], args_dict['quiet'], parse_cache))
+        process.daemon = True
+        process.start()
+        workers.append((process, tasks, results))
+
+    def get_file(filepath, file_stat, worker):
+        if worker is None:
+            cmdline.print_cmdline(
+                "File {0} unchanged since last import".format(filepath))
+            return
+        kind, value, output = get_message(worker)
+        if kind == 'error':
+            # hashing failed, there is nothing to import
+            sys.stdout.write(output)
+            print(value)
+            return
+
+        file_state = {'done': False}
+        yield (filepath, file_stat, value,
+               receive_items(worker, output, file_state, loc_stats))
+        # the next file of the worker comes after the rest of this one
+        if not file_state['done']:
+            skip_items(worker)
+
+    pending = deque()
+    num_started = 0
+    try:
+        for filepath in filepaths:
+            filepath = os.path.abspath(filepath)
+            file_stat = helper.get_file_stat(filepath)
+            worker = None
+            if manifest.get(filepath) != file_stat:
+                worker = workers[num_started % jobs]
+                worker[1].put((filepath, args_dict['wkb'],
+                               args_dict['parser']))
+                num_started += 1
+            pending.append((filepath, file_stat, worker))
+
+            while len(pending) > 2 * jobs:
+                for parsed in get_file(*pending.popleft()):
+                    yield parsed
+
+        while pending:
+            for parsed in get_file(*pending.popleft()):
+                yield parsed
+
+        for process, tasks, results in workers:
+            tasks.put(None)
+        for process, tasks, results in workers:
+            process.join()
+    finally:
+        for process, tasks, results in workers:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+def rebuild_spatial_indexes(conn):
+    """
+    Rebuild the spatial indexes disabled by a bulk import.
+    """
+    rebuild_starttime = datetime.now()
+    db_helper.rebuild_spatial_indexes(conn)
+    msg = "Rebuilding spatial indexes took {0}"
+    cmdline.print_cmdline(msg.format(datetime.now() - rebuild_starttime))
+
+
 def importer(args_dict):
     """
     you know what 'main' does - run everything in the right order and
@@ -179,6 +610,12 @@ def importer(args_dict):
     dbpath = os.path.expanduser(args_dict['dbpath'])
     skip_locs = args_dict['skip_locs']
     quiet = args_dict['quiet']
+    profile = args_dict['profile']
+    bulk = args_dict['bulk']
+    commit_every = args_dict['commit_every']
+    commit_points = args_dict['commit_points']
+    verify = args_dict['verify']
+    jobs = args_dict['jobs']
 
     # -------------------------------------------------------------------------
 
@@ -187,12 +624,16 @@ def importer(args_dict):
 
     cmdline.set_print_verbose(not quiet)
 
-    conn = spatialite_finder.get_connection(dbpath)
+    if gpx.get_parser(args_dict['parser']) != args_dict['parser']:
+        cmdline.print_cmdline("lxml is not installed, using the gpxpy parser")
+
+    conn = spatialite_finder.get_connection(dbpath, profile)
     cursor = conn.cursor()
 
     # -------------------------------------------------------------------------
 
-    gpx_filepaths = cmdline.read_filepaths(filepaths, ".gpx")
+    gpx_filepaths = cmdline.sort_filepaths(
+        cmdline.read_filepaths(filepaths, ".gpx"), args_dict['file_order'])
     cmdline.print_cmdline(
         "\nFound {0} .gpx files.\n".format(len(gpx_filepaths)))
 
@@ -226,86 +667,80 @@ def importer(args_dict):
 
     # -------------------------------------------------------------------------
 
-    get_loc_func = None if skip_locs else db.get_location_func(cursor)
-
-    # -------------------------------------------------------------------------
-
-    for filepath in gpx_filepaths:
-
-        # ---------------------------------------------------------------------
-
-        if db.check_if_gpxfile_exists(cursor, filepath) is True:
-            cmdline.print_cmdline(
-                "File {0} already in database".format(filepath))
-            continue
-
-        # ---------------------------------------------------------------------
-
-        parsing_starttimep = datetime.now()
-        cmdline.print_cmdline("#" * 48)
-        cmdline.print_cmdline("Parsing points in {0}".format(filepath))
-
-        # ---------------------------------------------------------------------
-
-        trkpts, trklines, firsttimestamp, lasttimestamp, wpts, seg_uuids = \
-            gpx.extractpoints(filepath, get_loc_func, False)
-
-        # ---------------------------------------------------------------------
-
-        seg_dict = db.insert_segments(cursor, seg_uuids)
-
-        # ---------------------------------------------------------------------
-
-        msg = "File first timestamp: {0}, last timestamp: {1}"
-        cmdline.print_cmdline(msg.format(firsttimestamp, lasttimestamp))
-
-        if firsttimestamp == 0 or lasttimestamp == 0:
-            continue
-            cmdline.print_cmdline("Skipping importing {0}.".format(filepath))
-
-        # ---------------------------------------------------------------------
-
-        parsing_endtime = datetime.now()
-        parsing_duration = parsing_endtime - parsing_starttimep
-        msg = "\nParsing {0} points and {1} waypoints from gpx file took {2}"
+    if db_helper.get_disabled_spatial_indexes(conn):
         cmdline.print_cmdline(
-            msg.format(len(trkpts), len(wpts), parsing_duration))
-
-        # ---------------------------------------------------------------------
+            "Found spatial indexes disabled by an interrupted bulk import")
+        rebuild_spatial_indexes(conn)
 
-        db_starttime = datetime.now()
-
-        # print "Entering file into database"
-        db.enterfile(filepath, cursor, userid, firsttimestamp, lasttimestamp)
-
-        file_uid = db.get_currentfileid(cursor)
-
-        # print "Entering points into database"
-        db.enterpoints(cursor, userid, trkpts, file_uid, seg_dict)
-
-        # print "Entering lines into database"
-        db.enterlines(cursor, userid, trklines, file_uid, seg_dict)
+    # -------------------------------------------------------------------------
 
-        # print entering waypoints into database
-        db.enterwaypoints(cursor, userid, wpts, file_uid)
+    db_helper.create_manifest_table(conn)
+    manifest = {} if verify else db.get_manifest(cursor)
 
-        # ---------------------------------------------------------------------
+    # -------------------------------------------------------------------------
 
-        conn.commit()
+    # files are parsed by worker processes and entered by this process
+    # only, sqlite allows a single writer
+    if jobs > 1:
+        loc_stats = None if skip_locs else {}
+        gpx_files = parse_files(gpx_filepaths, manifest, args_dict,
+                                loc_stats)
+    else:
+        get_loc_func = None if skip_locs else db.get_location_func(cursor)
+        loc_stats = None if skip_locs else get_loc_func.stats
+        gpx_files = read_files(gpx_filepaths, manifest, get_loc_func,
+                               args_dict)
 
-        # ---------------------------------------------------------------------
-        db_endtime = datetime.now()
-        db_duration = db_endtime - db_starttime
-        msg = "Entering into database took {0}"
-        cmdline.print_cmdline(msg.format(db_duration))
+    # -------------------------------------------------------------------------
 
-        # ---------------------------------------------------------------------
+    if bulk:
+        cmdline.print_cmdline("Disabling spatial indexes for bulk import")
+        db_helper.disable_spatial_indexes(conn)
+
+    # savepoints of single files are nested in a transaction spanning
+    # several files, which is begun and committed here rather than
+    # implicitly by the sqlite module
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    in_transaction = False
+    try:
+        pending_files = 0
+        pending_points = 0
+        for filepath, file_stat, md5hash, items in gpx_files:
+            if not in_transaction:
+                cursor.execute("BEGIN")
+                in_transaction = True
+
+            num_points = import_file(cursor, filepath, file_stat, md5hash,
+                                     items, userid, args_dict)
+            if num_points is None:
+                continue
+
+            pending_files += 1
+            pending_points += num_points
+            if ((commit_every > 0 and pending_files >= commit_every) or
+                    (commit_points > 0 and pending_points >= commit_points)):
+                conn.commit()
+                in_transaction = False
+                pending_files = 0
+                pending_points = 0
+    finally:
+        gpx_files.close()
+        # an interrupted file has been rolled back to its savepoint, the
+        # files imported before it are kept
+        if in_transaction:
+            conn.commit()
+        conn.isolation_level = isolation_level
+        if bulk:
+            rebuild_spatial_indexes(conn)
 
     cursor.close()
     conn.close()
 
     endtime = datetime.now()
     cmdline.print_cmdline("#" * 48)
+    if loc_stats:
+        cmdline.print_cmdline(locations.format_stats(loc_stats))
     cmdline.print_cmdline("Script took {0}\n".format(endtime - starttime))
 
 
@@ -335,6 +770,62 @@ def main():
                                (faster)')
     parser_importer.add_argument('-q', '--quiet', dest='quiet', default=False,
                                  action='store_true')
+    parser_importer.add_argument('-c', '--chunk-size', dest='chunk_size',
+                                 metavar='ROWS', type=int,
+                                 default=db.DEFAULT_CHUNK_SIZE,
+                                 help='Number of rows written per batch \
+                                 (default: %(default)s)')
+    parser_importer.add_argument('-w', '--wkb', dest='wkb', default=False,
+                                 action='store_true',
+                                 help='Pass geometries to spatialite as WKB \
+                                 blobs instead of WKT (faster)')
+    parser_importer.add_argument('-b', '--bulk', dest='bulk', default=False,
+                                 action='store_true',
+                                 help='Disable spatial indexes while \
+                                 importing and rebuild them afterwards \
+                                 (faster for large imports)')
+    parser_importer.add_argument('--commit-every', dest='commit_every',
+                                 metavar='FILES', type=int, default=1,
+                                 help='Commit after this many imported \
+                                 files (default: %(default)s)')
+    parser_importer.add_argument('--commit-points', dest='commit_points',
+                                 metavar='POINTS', type=int, default=0,
+                                 help='Also commit once this many \
+                                 trackpoints are pending (default: off)')
+    parser_importer.add_argument('--parser', dest='parser',
+                                 choices=gpx.PARSERS, default='gpxpy',
+                                 help='Set gpx parser, "stream" and "lxml" \
+                                 keep memory usage independent of file \
+                                 size, "lxml" falls back to "gpxpy" if \
+                                 lxml is not installed \
+                                 (default: %(default)s)')
+    parser_importer.add_argument('-j', '--jobs', dest='jobs', metavar='N',
+                                 type=int, default=1,
+                                 help='Hash and parse files in N worker \
+                                 processes, the database is written by \
+                                 the main process only \
+                                 (default: %(default)s)')
+    parser_importer.add_argument('--file-order', dest='file_order',
+                                 choices=cmdline.FILE_ORDERS,
+                                 default='input',
+                                 help='Order in which files are imported \
+                                 and numbered: as found, by path or by \
+                                 modification time (default: %(default)s)')
+    parser_importer.add_argument('--cache', dest='cache_dir',
+                                 metavar='DIR',
+                                 help='Keep parsed files in a cache in DIR \
+                                 and read files found in the cache from \
+                                 there instead of parsing them again')
+    parser_importer.add_argument('--cache-size', dest='cache_size',
+                                 metavar='MB', type=int,
+                                 default=cache.DEFAULT_MAX_SIZE // 2 ** 20,
+                                 help='Remove the least recently used \
+                                 files from the cache once it grows larger \
+                                 (default: %(default)s)')
+    parser_importer.add_argument('--verify', dest='verify', default=False,
+                                 action='store_true',
+                                 help='Hash every file, even files recorded \
+                                 unchanged in the import manifest')
     parser_importer.add_argument('gpx_files', nargs='+', metavar='input-files',
                                  help='/path/to/gpx-file.gpx or \
                                  /path/to/folder')
@@ -398,6 +889,18 @@ def main():
                                  help='/path/to/database.sqlite')
     parser_citydefs.set_defaults(func=citydefs)
 
+    # only exporting citydefs works with a read only profile
+    for subparser, writable in ((parser_importer, True),
+                                (parser_create_db, True),
+                                (parser_update_locs, True),
+                                (parser_citydefs, False)):
+        subparser.add_argument('-p',
+                               '--profile',
+                               dest='profile',
+                               choices=spatialite_finder.get_profiles(
+                                   writable),
+                               help='Set sqlite PRAGMA performance profile')
+
     # -------------------------------------------------------------------------
     # when there is no subcommand add default to arguments list
     if (len(sys.argv) > 1
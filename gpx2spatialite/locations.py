@@ -0,0 +1,497 @@
+# Copyright (C) 2013, 2014
+# Daniel Belasco Rogers <http://planbperformance.net/dan>,
+# Peter Vasil <mail@petervasil.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see [http://www.gnu.org/licenses/].
+
+from array import array
+from fractions import Fraction
+from collections import OrderedDict
+from math import ceil, floor, sqrt
+
+
+# citydef_uid of the 'Unknown' citydef
+UNKNOWN_LOCATION = 1
+
+DEFAULT_NODE_CAPACITY = 8
+# grid cells of about 1 km and the number of cells kept
+DEFAULT_CELL_SIZE = 0.01
+DEFAULT_MAX_CELLS = 65536
+# cells of the coverage bitmap in degrees
+DEFAULT_COVERAGE_RESOLUTION = 0.25
+
+# relative error bound of the floating point orientation test
+_SAFE_EPSILON = 1e-15
+# margin in degrees around boxes tested by classify_box
+_BOX_MARGIN = 1e-9
+
+
+class STRtree(object):
+    """
+    Static R-tree of bounding boxes, packed with the sort-tile-recursive
+    algorithm
+
+    entries is a list of (bounds, item) with bounds as
+    (minx, miny, maxx, maxy). A node is a tuple (minx, miny, maxx, maxy,
+    children, is_leaf) whose children are (minx, miny, maxx, maxy, item)
+    tuples for leaf nodes and nodes otherwise.
+    """
+
+    def __init__(self, entries, node_capacity=DEFAULT_NODE_CAPACITY):
+        self.node_capacity = node_capacity
+        self.size = len(entries)
+
+        nodes = [tuple(bounds) + (item,) for bounds, item in entries]
+        is_leaf = True
+        while len(nodes) > 1 or (is_leaf and nodes):
+            nodes = self._pack(nodes, is_leaf)
+            is_leaf = False
+        self.root = nodes[0] if nodes else None
+
+    def __len__(self):
+        return self.size
+
+    def _pack(self, nodes, is_leaf):
+        """
+        Group nodes into parent nodes of at most node_capacity children,
+        tiled by the centers of their boxes
+        """
+        capacity = self.node_capacity
+        num_parents = int(ceil(len(nodes) / float(capacity)))
+        num_slices = int(ceil(sqrt(num_parents)))
+        slice_size = num_slices * capacity
+
+        parents = []
+        nodes = sorted(nodes, key=lambda node: node[0] + node[2])
+        for start in range(0, len(nodes), slice_size):
+            tile = sorted(nodes[start:start + slice_size],
+                          key=lambda node: node[1] + node[3])
+            for index in range(0, len(tile), capacity):
+                children = tile[index:index + capacity]
+                parents.append((min(child[0] for child in children),
+                                min(child[1] for child in children),
+                                max(child[2] for child in children),
+                                max(child[3] for child in children),
+                                tuple(children), is_leaf))
+        return parents
+
+    def query(self, x, y):
+        """
+        Return the items whose bounds contain the point x, y
+        """
+        return self.query_box(x, y, x, y)
+
+    def query_box(self, minx, miny, maxx, maxy):
+        """
+        Return the items whose bounds intersect the box
+        """
+        items = []
+        if self.root is None:
+            return items
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if (node[0] > maxx or node[2] < minx or node[1] > maxy or
+                    node[3] < miny):
+                continue
+            if node[5]:
+                for child in node[4]:
+                    if (child[0] <= maxx and child[2] >= minx and
+                            child[1] <= maxy and child[3] >= miny):
+                        items.append(child[4])
+            else:
+                stack.extend(node[4])
+        return items
+
+
+def orientation(x1, y1, x2, y2, x, y):
+    """
+    Return 1 if the point x, y lies left of the line from x1, y1 to
+    x2, y2, -1 if it lies right of it and 0 if it is on the line. Close
+    to the line the sign is computed exactly, like GEOS does for
+    spatialite's within.
+    """
+    detleft = (x1 - x) * (y2 - y)
+    detright = (y1 - y) * (x2 - x)
+    det = detleft - detright
+    if detleft > 0:
+        if detright <= 0:
+            return _sign(det)
+        detsum = detleft + detright
+    elif detleft < 0:
+        if detright >= 0:
+            return _sign(det)
+        detsum = -detleft - detright
+    else:
+        return _sign(det)
+
+    if abs(det) >= _SAFE_EPSILON * detsum:
+        return _sign(det)
+
+    x = Fraction(x)
+    y = Fraction(y)
+    return _sign((Fraction(x1) - x) * (Fraction(y2) - y) -
+                 (Fraction(y1) - y) * (Fraction(x2) - x))
+
+
+def _sign(value):
+    return (value > 0) - (value < 0)
+
+
+def locate_in_ring(x, y, ring):
+    """
+    Return 1 if the point x, y is inside the closed ring (a flat array of
+    x, y values), 0 if it is outside and -1 if it is on the ring. The
+    crossings of a ray from the point are counted as by GEOS.
+    """
+    crossings = 0
+    x1 = ring[0]
+    y1 = ring[1]
+    for index in range(2, len(ring) - 1, 2):
+        x2 = x1
+        y2 = y1
+        x1 = ring[index]
+        y1 = ring[index + 1]
+        if x1 < x and x2 < x:
+            continue
+        if x == x2 and y == y2:
+            return -1
+        if y1 == y and y2 == y:
+            if x1 <= x <= x2 or x2 <= x <= x1:
+                return -1
+            continue
+        if (y1 > y and y2 <= y) or (y2 > y and y1 <= y):
+            orient = orientation(x1, y1, x2, y2, x, y)
+            if orient == 0:
+                return -1
+            if y2 < y1:
+                orient = -orient
+            if orient > 0:
+                crossings += 1
+    return crossings % 2
+
+
+def polygon_contains(rings, x, y):
+    """
+    Checks if the point x, y lies in the interior of a polygon, given as
+    list of rings with the exterior ring first. Points on the boundary
+    are not contained, like with spatialite's within.
+    """
+    if locate_in_ring(x, y, rings[0]) != 1:
+        return False
+    for hole in rings[1:]:
+        if locate_in_ring(x, y, hole) != 0:
+            return False
+    return True
+
+
+def polygon_contains_box(rings, minx, miny, maxx, maxy):
+    """
+    Checks if the box lies in the interior of a polygon (see classify_box)
+    """
+    return classify_box(rings, minx, miny, maxx, maxy) == 1
+
+
+def classify_box(rings, minx, miny, maxx, maxy):
+    """
+    Return 1 if the box lies in the interior of a polygon, 0 if it lies
+    outside of it and -1 if the boundary of the polygon comes near the
+    box. Without a polygon edge near the box, a corner of the box decides.
+    The box is enlarged by _BOX_MARGIN, so rounding can only turn boxes
+    lying inside or outside into -1.
+    """
+    outer_minx = minx - _BOX_MARGIN
+    outer_miny = miny - _BOX_MARGIN
+    outer_maxx = maxx + _BOX_MARGIN
+    outer_maxy = maxy + _BOX_MARGIN
+    for ring in rings:
+        x1 = ring[0]
+        y1 = ring[1]
+        for index in range(2, len(ring) - 1, 2):
+            x2 = ring[index]
+            y2 = ring[index + 1]
+            if _segment_intersects_box(x1, y1, x2, y2, outer_minx,
+                                       outer_miny, outer_maxx, outer_maxy):
+                return -1
+            x1 = x2
+            y1 = y2
+    return 1 if polygon_contains(rings, minx, miny) else 0
+
+
+def _segment_intersects_box(x1, y1, x2, y2, minx, miny, maxx, maxy):
+    if (min(x1, x2) > maxx or max(x1, x2) < minx or
+            min(y1, y2) > maxy or max(y1, y2) < miny):
+        return False
+    # the boxes overlap, the segment misses the box only if all corners
+    # of the box lie on the same side of its line
+    sides = set()
+    for x, y in ((minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy)):
+        det = (x2 - x1) * (y - y1) - (y2 - y1) * (x - x1)
+        sides.add((det > 0) - (det < 0))
+    return len(sides) > 1 or 0 in sides
+
+
+def get_bounds(ring):
+    """
+    Return the bounding box (minx, miny, maxx, maxy) of a ring
+    """
+    xs = ring[0::2]
+    ys = ring[1::2]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class CitydefIndex(object):
+    """
+    In-memory spatial index of the citydefs for the location lookup of
+    trackpoints and waypoints
+
+    citydefs is a sequence of (citydef_uid, polygons) with polygons as
+    returned by helper.polygons_from_wkb. The polygons are kept in an
+    STRtree of their bounding boxes and candidates are checked with an
+    exact point in polygon test.
+
+    Points outside the envelope of all citydefs or in a cell of the
+    coverage bitmap (coverage_resolution degrees) which no citydef
+    reaches are located as UNKNOWN_LOCATION right away. Other points are
+    looked up in a grid of cells of cell_size degrees.
+    A cell lying inside one citydef or outside all of them is answered
+    without a point in polygon test, cells on a boundary fall through to
+    the exact test. At most max_cells cells are kept, the least recently
+    used ones are dropped. The cells are only valid for the citydefs the
+    index was built from, an index of changed citydefs starts without
+    cells.
+
+    The index is called like get_location with lon, lat. Whole segments
+    are located with locate_segment, which counts the points resolved by
+    its shortcuts in stats.
+    """
+
+    def __init__(self, citydefs, node_capacity=DEFAULT_NODE_CAPACITY,
+                 cell_size=DEFAULT_CELL_SIZE, max_cells=DEFAULT_MAX_CELLS,
+                 coverage_resolution=DEFAULT_COVERAGE_RESOLUTION):
+        entries = []
+        for citydef_uid, polygons in citydefs:
+            for rings in polygons:
+                if not rings or len(rings[0]) < 8:
+                    continue
+                bounds = get_bounds(rings[0])
+                # polygons without area, like the one of 'Unknown',
+                # contain no point
+                if bounds[0] == bounds[2] or bounds[1] == bounds[3]:
+                    continue
+                entries.append((bounds, [citydef_uid, rings, False]))
+        self.tree = STRtree(entries, node_capacity)
+
+        self.envelope = None
+        if self.tree.root is not None:
+            self.envelope = self.tree.root[:4]
+        self.coverage_resolution = coverage_resolution
+        self.coverage_width = int(ceil(360 / coverage_resolution)) + 1
+        self.coverage = bytearray(
+            (self.coverage_width * (int(ceil(180 / coverage_resolution)) +
+                                    1) + 7) // 8)
+        for bounds, entry in entries:
+            self._set_coverage(*bounds)
+
+        # a polygon whose bounds overlap a polygon with a lower uid may
+        # not be the location of the points it contains
+        for bounds, entry in entries:
+            entry[2] = any(other[0] < entry[0]
+                           for other in self.tree.query_box(*bounds))
+
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.cells = OrderedDict()
+
+        self.stats = {}
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.tree)
+
+    def __call__(self, lon, lat):
+        return self.locate(lon, lat)
+
+    def reset_stats(self):
+        """
+        Reset the counts of located points ('points'), points located by
+        the bounds of their segment ('bounds_hits'), by the envelope and
+        the coverage bitmap ('rejects'), by their grid cell ('cell_hits')
+        and by the citydef of the previous point ('previous_hits')
+        """
+        self.stats.update(points=0, bounds_hits=0, rejects=0, cell_hits=0,
+                          previous_hits=0)
+
+    def _get_coverage_index(self, lon, lat):
+        """
+        Return the bit of the coverage bitmap of a point inside the
+        envelope
+        """
+        resolution = self.coverage_resolution
+        column = int(floor((lon + 180) / resolution))
+        row = int(floor((lat + 90) / resolution))
+        return row * self.coverage_width + column
+
+    def _set_coverage(self, minx, miny, maxx, maxy):
+        """
+        Mark the cells of the coverage bitmap reached by a bounding box
+        """
+        first = self._get_coverage_index(minx, miny)
+        last = self._get_coverage_index(maxx, maxy)
+        num_columns = (last - first) % self.coverage_width + 1
+        for row_start in range(first, last + 1, self.coverage_width):
+            for index in range(row_start, row_start + num_columns):
+                self.coverage[index >> 3] |= 1 << (index & 7)
+
+    def covers(self, lon, lat):
+        """
+        Checks if a citydef may contain the point. Points outside the
+        envelope of the citydefs or in a cell of the coverage bitmap
+        without citydefs are not contained by any citydef.
+        """
+        envelope = self.envelope
+        if envelope is None or not (envelope[0] <= lon <= envelope[2] and
+                                    envelope[1] <= lat <= envelope[3]):
+            return False
+        index = self._get_coverage_index(lon, lat)
+        return bool(self.coverage[index >> 3] & (1 << (index & 7)))
+
+    def locate(self, lon, lat):
+        """
+        Return the citydef_uid of the citydef containing the point, the
+        lowest one if citydefs overlap, UNKNOWN_LOCATION if there is none
+        """
+        self.stats['points'] += 1
+        if not self.covers(lon, lat):
+            self.stats['rejects'] += 1
+            return UNKNOWN_LOCATION
+        cell = self._get_cell(lon, lat)
+        if cell is not None:
+            self.stats['cell_hits'] += 1
+            return cell[0]
+        return self._search(lon, lat)[0]
+
+    def _search(self, lon, lat):
+        """
+        Return the location of the point and the entry of the polygon
+        containing it
+        """
+        found = None
+        for entry in self.tree.query(lon, lat):
+            if found is not None and entry[0] >= found[0]:
+                continue
+            if polygon_contains(entry[1], lon, lat):
+                found = entry
+        if found is None:
+            return UNKNOWN_LOCATION, None
+        return found[0], found
+
+    def _classify(self, minx, miny, maxx, maxy):
+        """
+        Return the location and the polygon entry of all points in the
+        box, None if the box is not inside one citydef or outside of all
+        """
+        for entry in sorted(self.tree.query_box(minx, miny, maxx, maxy),
+                            key=lambda entry: entry[0]):
+            position = classify_box(entry[1], minx, miny, maxx, maxy)
+            if position == 1:
+                return entry[0], entry
+            elif position == -1:
+                return None
+        return UNKNOWN_LOCATION, None
+
+    def _get_cell(self, lon, lat):
+        """
+        Return the location and the polygon entry of the grid cell of the
+        point, None for cells on the boundary of a citydef
+        """
+        key = (int(floor(lon / self.cell_size)),
+               int(floor(lat / self.cell_size)))
+        try:
+            cell = self.cells.pop(key)
+        except KeyError:
+            cell = self._classify(key[0] * self.cell_size,
+                                  key[1] * self.cell_size,
+                                  (key[0] + 1) * self.cell_size,
+                                  (key[1] + 1) * self.cell_size)
+            if len(self.cells) >= self.max_cells:
+                self.cells.popitem(last=False)
+        self.cells[key] = cell
+        return cell
+
+    def locate_segment(self, lons, lats):
+        """
+        Return the locations of the points of a segment as array. If the
+        bounding box of the segment lies inside one citydef or outside of
+        all of them, all points get the same location. Otherwise points
+        are checked with covers, looked up in their grid cell and then
+        tested against the polygon of the previous point before the index
+        is searched.
+        """
+        num_points = len(lons)
+        self.stats['points'] += num_points
+        if num_points == 0:
+            return array('l')
+
+        bounds = (min(lons), min(lats), max(lons), max(lats))
+        cell = self._classify(*bounds)
+        if cell is not None:
+            self.stats['bounds_hits'] += num_points
+            return array('l', [cell[0]]) * num_points
+
+        locs = array('l')
+        previous = None
+        rejects = 0
+        cell_hits = 0
+        previous_hits = 0
+        for lon, lat in zip(lons, lats):
+            if not self.covers(lon, lat):
+                locs.append(UNKNOWN_LOCATION)
+                previous = None
+                rejects += 1
+                continue
+            cell = self._get_cell(lon, lat)
+            if cell is not None:
+                loc_id, previous = cell
+                cell_hits += 1
+            elif previous is not None and \
+                    polygon_contains(previous[1], lon, lat):
+                loc_id = previous[0]
+                previous_hits += 1
+            else:
+                loc_id, previous = self._search(lon, lat)
+            if previous is not None and previous[2]:
+                previous = None
+            locs.append(loc_id)
+        self.stats['rejects'] += rejects
+        self.stats['cell_hits'] += cell_hits
+        self.stats['previous_hits'] += previous_hits
+        return locs
+
+
+def format_stats(stats):
+    """
+    Return a message with the shares of the points located by the
+    shortcuts of CitydefIndex
+    """
+    points = stats['points']
+    if points == 0:
+        return "Located 0 points"
+    hits = [stats['bounds_hits'], stats['rejects'], stats['cell_hits'],
+            stats['previous_hits']]
+    msg = ("Located {0} points: {1:.1%} by segment bounds, {2:.1%} outside "
+           "of all citydefs, {3:.1%} by grid cell, {4:.1%} by the previous "
+           "point's citydef, {5:.1%} searched")
+    return msg.format(points, *[count / float(points)
+                                for count in hits + [points - sum(hits)]])
@@ -0,0 +1,348 @@
+# Copyright (C) 2013, 2014
+# Daniel Belasco Rogers <http://planbperformance.net/dan>,
+# Peter Vasil <mail@petervasil.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see [http://www.gnu.org/licenses/].
+
+from array import array
+from calendar import timegm
+try:
+    import copyreg
+except ImportError:
+    import copy_reg as copyreg
+from datetime import datetime, timedelta
+from gpxpy import gpxfield
+from . import helper
+
+
+_EPOCH = datetime(1970, 1, 1)
+_NO_TIME = float('nan')
+# gpxpy's time zone of timestamps ending with Z
+_UTC = gpxfield.SimpleTZ('Z')
+# utc offset of a segment before its first timed point
+_NO_OFFSET = object()
+
+
+def _make_tz(offset):
+    tzinfo = gpxfield.SimpleTZ()
+    tzinfo.offset = offset
+    return tzinfo
+
+
+def _reduce_tz(tzinfo):
+    return _make_tz, (tzinfo.offset,)
+
+
+# Python 2 pickles tzinfo without its __slots__, so items sent by the import
+# workers would lose the offset of gpxpy's time zones
+copyreg.pickle(gpxfield.SimpleTZ, _reduce_tz)
+
+# seconds since the epoch of the dates of fixed-width timestamps
+_day_seconds = {}
+_DAY_CACHE_SIZE = 4096
+
+
+def to_epoch(time):
+    """
+    Seconds since 1970-01-01 UTC of a datetime, naive datetimes are taken
+    as UTC. Returns NaN for None.
+    """
+    if time is None:
+        return _NO_TIME
+    offset = time.utcoffset()
+    seconds = timegm(time.timetuple()) + time.microsecond / 1e6
+    if offset:
+        seconds -= offset.total_seconds()
+    return seconds
+
+
+def from_epoch(seconds, utcoffset=0.0, tzinfo=None):
+    """
+    Datetime of seconds since 1970-01-01 UTC in the time zone tzinfo with
+    the offset utcoffset in seconds. Returns None for NaN.
+    """
+    if seconds != seconds:
+        return None
+    local = _EPOCH + timedelta(
+        microseconds=int(round((seconds + utcoffset) * 1e6)))
+    if tzinfo is None:
+        return local
+    return local.replace(tzinfo=tzinfo)
+
+
+def get_offset(time):
+    """
+    Return the utc offset of a datetime in seconds, None for naive
+    datetimes and time zones without offset
+    """
+    offset = time.utcoffset()
+    if offset is None:
+        return None
+    return offset.total_seconds()
+
+
+def parse_utc_timestamp(text):
+    """
+    Seconds since the epoch of a timestamp in the fixed-width form
+    YYYY-MM-DDTHH:MM:SSZ, without building a datetime. The seconds of a
+    date are cached, as consecutive points mostly share it. Returns None
+    for timestamps in any other form.
+    """
+    if (len(text) != 20 or text[10] != 'T' or text[13] != ':' or
+            text[16] != ':' or text[19] != 'Z'):
+        return None
+    clock = text[11:13] + text[14:16] + text[17:19]
+    if not clock.isdigit():
+        return None
+    hours = int(clock[:2])
+    minutes = int(clock[2:4])
+    seconds = int(clock[4:])
+    if hours > 23 or minutes > 59 or seconds > 59:
+        return None
+
+    date = text[:10]
+    day = _day_seconds.get(date)
+    if day is None:
+        if date[4] != '-' or date[7] != '-' or \
+                not (date[:4] + date[5:7] + date[8:]).isdigit():
+            return None
+        try:
+            day = timegm(datetime(int(date[:4]), int(date[5:7]),
+                                  int(date[8:])).timetuple())
+        except ValueError:
+            return None
+        if len(_day_seconds) >= _DAY_CACHE_SIZE:
+            _day_seconds.clear()
+        _day_seconds[date] = day
+
+    return float(day + hours * 3600 + minutes * 60 + seconds)
+
+
+def parse_time(text):
+    """
+    Return a timestamp of a gpx file as datetime like gpxpy does, None
+    if it can not be parsed
+    """
+    seconds = parse_utc_timestamp(text) if text else None
+    if seconds is None:
+        return gpxfield.TIME_TYPE.from_string(text)
+    return (_EPOCH + timedelta(seconds=seconds)).replace(tzinfo=_UTC)
+
+
+class TrackSegment(object):
+    """
+    Columnar storage of the points of a track segment
+
+    Every point attribute is kept in its own array (lon, lat, ele, time,
+    speed, course and loc), so a point takes 56 bytes instead of a list of
+    Python objects. time holds seconds since the epoch, NaN for points
+    without a timestamp. Datetimes are rebuilt with the time zone of the
+    first timed point of the segment. Timed points with another utc offset
+    keep their datetime in other_times, keyed by the point index.
+
+    The segment statistics (timestamp_start, timestamp_end, length_m,
+    time_sec and speed_kph) are set by gpx.extract_segment.
+    """
+
+    __slots__ = ('seg_uuid', 'lon', 'lat', 'ele', 'time', 'speed', 'course',
+                 'loc', 'tzinfo', 'utcoffset', 'offset', 'other_times',
+                 'timestamp_start', 'timestamp_end', 'length_m', 'time_sec',
+                 'speed_kph')
+
+    def __init__(self, seg_uuid):
+        self.seg_uuid = seg_uuid
+        self.lon = array('d')
+        self.lat = array('d')
+        self.ele = array('d')
+        self.time = array('d')
+        self.speed = array('d')
+        self.course = array('d')
+        self.loc = array('l')
+        self.tzinfo = None
+        self.utcoffset = 0.0
+        self.offset = _NO_OFFSET
+        self.other_times = {}
+        self.timestamp_start = None
+        self.timestamp_end = None
+        self.length_m = 0
+        self.time_sec = 0.0
+        self.speed_kph = 0.0
+
+    def __len__(self):
+        return len(self.lon)
+
+    def append(self, lon, lat, ele, time, speed, course, loc=-1):
+        """
+        Add a point to the end of the segment. time is a datetime or the
+        text of the gpx file's time element, which is converted without
+        building a datetime if it has the form YYYY-MM-DDTHH:MM:SSZ.
+        """
+        seconds = None
+        if isinstance(time, str):
+            seconds = parse_utc_timestamp(time)
+            if seconds is None:
+                time = gpxfield.TIME_TYPE.from_string(time)
+            elif self.offset is _NO_OFFSET:
+                self.tzinfo = _UTC
+                self.utcoffset = 0.0
+                self.offset = 0.0
+            elif self.offset != 0.0:
+                self.other_times[len(self)] = \
+                    (_EPOCH + timedelta(seconds=seconds)).replace(tzinfo=_UTC)
+        if seconds is None:
+            if time is not None:
+                if self.offset is _NO_OFFSET:
+                    self.set_timezone(time)
+                elif get_offset(time) != self.offset:
+                    self.other_times[len(self)] = time
+            seconds = to_epoch(time)
+
+        self.lon.append(lon)
+        self.lat.append(lat)
+        self.ele.append(ele)
+        self.time.append(seconds)
+        self.speed.append(speed)
+        self.course.append(course)
+        self.loc.append(loc)
+
+    def set_timezone(self, time):
+        """
+        Use the time zone of time when datetimes are rebuilt
+        """
+        self.tzinfo = time.tzinfo
+        self.offset = get_offset(time)
+        self.utcoffset = self.offset or 0.0
+
+    def get_time(self, index):
+        """
+        Return the timestamp of a point as datetime, None if the point has
+        no time
+        """
+        if index in self.other_times:
+            return self.other_times[index]
+        return from_epoch(self.time[index], self.utcoffset, self.tzinfo)
+
+    def get_times(self):
+        """
+        Return the timestamps of all points as datetimes
+        """
+        return [self.get_time(index) for index in range(len(self))]
+
+    def get_time_bounds(self):
+        """
+        Return the first and the last timestamp of the segment as datetimes
+        """
+        timed = [index for index in range(len(self))
+                 if self.time[index] == self.time[index]]
+        if not timed:
+            return None, None
+        return self.get_time(timed[0]), self.get_time(timed[-1])
+
+    def get_timestamps(self):
+        """
+        Return the timestamps of all points as they are written into the
+        utctimestamp column, the same text as str(datetime). The text is
+        built from the seconds without datetimes, the date part is reused
+        for points of the same day. Points in other_times are formatted
+        from their datetime.
+        """
+        if self.tzinfo is None:
+            suffix = ''
+        else:
+            suffix = str(datetime(2000, 1, 1, tzinfo=self.tzinfo))[19:]
+
+        timestamps = []
+        last_day = None
+        date = None
+        other_times = self.other_times
+        for index, seconds in enumerate(self.time):
+            if seconds != seconds:
+                timestamps.append('None')
+                continue
+            if other_times and index in other_times:
+                timestamps.append(str(other_times[index]))
+                continue
+
+            microseconds = int(round((seconds + self.utcoffset) * 1e6))
+            day, microseconds = divmod(microseconds, 86400000000)
+            if day != last_day:
+                date = str((_EPOCH + timedelta(days=day)).date())
+                last_day = day
+            seconds, microseconds = divmod(microseconds, 1000000)
+            minutes, seconds = divmod(seconds, 60)
+            hours, minutes = divmod(minutes, 60)
+            if microseconds:
+                timestamps.append('{0} {1:02d}:{2:02d}:{3:02d}.{4:06d}{5}'
+                                  .format(date, hours, minutes, seconds,
+                                          microseconds, suffix))
+            else:
+                timestamps.append('{0} {1:02d}:{2:02d}:{3:02d}{4}'.format(
+                    date, hours, minutes, seconds, suffix))
+
+        return timestamps
+
+    def get_point_geometries(self, wkb=False):
+        """
+        Return the point geometries as WKB blobs or WKT strings
+        """
+        if wkb:
+            return [helper.point_wkb(lon, lat)
+                    for lon, lat in zip(self.lon, self.lat)]
+        return ["Point({0} {1})".format(lon, lat)
+                for lon, lat in zip(self.lon, self.lat)]
+
+    def get_linestring(self, wkb=False):
+        """
+        Return the segment as a linestring WKB blob or WKT string
+        """
+        if wkb:
+            coords = array('d', [0.0]) * (2 * len(self))
+            coords[0::2] = self.lon
+            coords[1::2] = self.lat
+            return helper.linestring_wkb(coords)
+        pts_strs = ["{0} {1}".format(lon, lat)
+                    for lon, lat in zip(self.lon, self.lat)]
+        return "LINESTRING(" + ",".join(pts_strs) + ")"
+
+    def locate(self, get_loc_func):
+        """
+        Look up the citydef of every point with get_loc_func(lon, lat), or
+        of the whole segment at once with get_loc_func.locate_segment if
+        it has one (see locations.CitydefIndex)
+        """
+        locate_segment = getattr(get_loc_func, 'locate_segment', None)
+        if locate_segment is not None:
+            self.loc = locate_segment(self.lon, self.lat)
+            return
+        self.loc = array('l', [get_loc_func(lon, lat)
+                               for lon, lat in zip(self.lon, self.lat)])
+
+    def trackpoints(self, wkb=False):
+        """
+        Return the points as trackpoint lines (see gpx.extractpoints)
+        """
+        return [[self.seg_uuid, trksegpt_id, ele, time, course, speed, loc,
+                 geom]
+                for trksegpt_id, (ele, time, course, speed, loc, geom)
+                in enumerate(zip(self.ele, self.get_times(), self.course,
+                                 self.speed, self.loc,
+                                 self.get_point_geometries(wkb)))]
+
+    def trackline(self, wkb=False):
+        """
+        Return the segment as trackline (see gpx.extractpoints)
+        """
+        return [self.seg_uuid, self.timestamp_start, self.timestamp_end,
+                self.length_m, self.time_sec, self.speed_kph,
+                self.get_linestring(wkb)]
@@ -0,0 +1,310 @@
+# Copyright (C) 2013, 2014
+# Daniel Belasco Rogers <http://planbperformance.net/dan>,
+# Peter Vasil <mail@petervasil.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see [http://www.gnu.org/licenses/].
+
+import bz2
+import contextlib
+import gzip
+import hashlib
+import mmap
+import os
+import stat
+import tarfile
+import zipfile
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# compressed single files, decompressed while they are read
+COMPRESSED_EXTENSIONS = {'.gz': gzip.open, '.bz2': bz2.BZ2File}
+if lzma is not None:
+    COMPRESSED_EXTENSIONS['.xz'] = lzma.open
+
+# errors raised for files, compressed files and archives which can not
+# be read, are corrupt or are truncated
+READ_ERRORS = (IOError, EOFError, zlib.error, zipfile.BadZipfile,
+               tarfile.TarError)
+if lzma is not None:
+    READ_ERRORS += (lzma.LZMAError,)
+
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+if lzma is not None:
+    TAR_EXTENSIONS += ('.tar.xz', '.txz')
+
+
+def get_compression(filepath):
+    """
+    Return the extension of a compressed single file, None if the file
+    is not compressed
+    """
+    lower_path = filepath.lower()
+    for extension in COMPRESSED_EXTENSIONS:
+        if lower_path.endswith(extension) and not is_archive(filepath):
+            return extension
+    return None
+
+
+def is_archive(filepath):
+    """
+    Checks if filepath names a zip or tar archive
+    """
+    return filepath.lower().endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
+
+
+def is_gpx_path(filepath, fileextension):
+    """
+    Checks if filepath ends with fileextension, optionally followed by
+    the extension of a compressed file (file.gpx, file.gpx.gz, ...)
+    """
+    lower_path = filepath.lower()
+    compression = get_compression(filepath)
+    if compression is not None:
+        lower_path = lower_path[:-len(compression)]
+    return lower_path.endswith(fileextension)
+
+
+def list_archive(archive_path, fileextension):
+    """
+    Returns the paths of the members of a zip or tar archive ending with
+    fileextension. A member path is the archive path followed by the
+    member name, e.g. tracks.zip/2014/track.gpx.
+    """
+    try:
+        if archive_path.lower().endswith(ZIP_EXTENSIONS):
+            with zipfile.ZipFile(archive_path) as archive:
+                names = [info.filename for info in archive.infolist()
+                         if not info.filename.endswith('/')]
+        else:
+            with tarfile.open(archive_path) as archive:
+                names = [info.name for info in archive.getmembers()
+                         if info.isfile()]
+    except READ_ERRORS as err:
+        print("Unable to read archive {0}: {1}".format(archive_path, err))
+        return []
+
+    return [archive_path + '/' + name for name in names
+            if name.lower().endswith(fileextension)]
+
+
+def split_archive_path(filepath):
+    """
+    Split a member path into the archive path and the member name.
+    Returns filepath and None if filepath is not inside an archive.
+    """
+    if os.path.exists(filepath):
+        return filepath, None
+
+    index = filepath.find('/')
+    while index != -1:
+        archive_path = filepath[:index]
+        if is_archive(archive_path) and os.path.isfile(archive_path):
+            return archive_path, filepath[index + 1:]
+        index = filepath.find('/', index + 1)
+
+    return filepath, None
+
+
+def open_source(filepath, archives=None):
+    """
+    Open a gpx file, a compressed gpx file or a gpx member of an archive
+    for reading. Returns a binary file object which yields the
+    decompressed content, nothing is extracted to disk. Plain files are
+    memory mapped (see open_mapped). Archive members are streamed,
+    through the ArchiveReader archives if one is passed. The returned
+    object can be used in a with statement.
+    """
+    archive_path, member = split_archive_path(filepath)
+    if member is None:
+        compression = get_compression(filepath)
+        if compression is None:
+            # mmap objects are no context managers in Python 2
+            return contextlib.closing(open_mapped(filepath))
+        return COMPRESSED_EXTENSIONS[compression](filepath, 'rb')
+
+    if archives is not None:
+        return contextlib.closing(archives.open(archive_path, member))
+
+    archives = ArchiveReader()
+    try:
+        member_file = archives.open(archive_path, member)
+    except Exception:
+        archives.close()
+        raise
+    return _close_member(member_file, archives)
+
+
+@contextlib.contextmanager
+def _close_member(member_file, archives):
+    """
+    Close an archive member opened by open_source and its archive
+    """
+    try:
+        yield member_file
+    finally:
+        member_file.close()
+        archives.close()
+
+
+def md5_file(source):
+    """
+    Return the md5 hexdigest of the content of the binary file object
+    source. Memory maps are hashed without copying them, other files are
+    read in chunks.
+
+    Source:
+    http://stackoverflow.com/a/11143944/464831
+    """
+    md5 = hashlib.md5()
+    if isinstance(source, mmap.mmap):
+        md5.update(source)
+    else:
+        for chunk in iter(lambda: source.read(128 * md5.block_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def open_mapped(filepath):
+    """
+    Map a regular file into memory for reading, so its pages are read
+    lazily by the operating system instead of being copied into Python
+    strings. The mmap object is used like a binary file. Pipes, special
+    files and empty files, which can not be mapped, are opened as
+    buffered files instead.
+    """
+    source = open(filepath, 'rb')
+    try:
+        if not stat.S_ISREG(os.fstat(source.fileno()).st_mode):
+            return source
+        mapped = MappedFile(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return source
+
+    # the mapping keeps its own handle of the file
+    source.close()
+    return mapped
+
+
+class MappedFile(mmap.mmap):
+    """
+    A read only memory map which, like a file, reads up to its end when
+    read is called without a size (Python 2's mmap requires one)
+    """
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self) - self.tell()
+        return mmap.mmap.read(self, size)
+
+
+class ArchiveReader(object):
+    """
+    Opens the members of zip and tar archives during an import.
+
+    Members are streamed, only a chunk of a member is decompressed at a
+    time. The last used archive stays open, so the members of a
+    compressed tar file read in archive order are decompressed in one
+    pass. The md5 hashes of the members of a tar file are computed all
+    at once in a single pass (see md5), so that hashing a member does not
+    make parsing it decompress the archive from its start again. Close
+    the reader, or use it as a context manager, when the import is done.
+    """
+
+    def __init__(self):
+        self.archive_path = None
+        self.archive = None
+        self.md5s = None
+        self.md5_error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self, archive_path, member):
+        """
+        Return a binary file object streaming the member of the archive at
+        archive_path. Raises IOError if the archive has no such member.
+        """
+        archive = self._get_archive(archive_path)
+        try:
+            if isinstance(archive, zipfile.ZipFile):
+                return archive.open(member)
+            member_file = archive.extractfile(member)
+        except KeyError:
+            member_file = None
+        if member_file is None:
+            raise IOError("No file {0} in {1}".format(member, archive_path))
+        return member_file
+
+    def md5(self, archive_path, member):
+        """
+        Return the md5 hexdigest of the member of the archive at
+        archive_path. Raises IOError if the archive has no such member and
+        one of READ_ERRORS if the archive is corrupt.
+        """
+        archive = self._get_archive(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            with contextlib.closing(self.open(archive_path,
+                                              member)) as member_file:
+                return md5_file(member_file)
+
+        if self.md5s is None:
+            # the members before a corrupt part of the archive keep their
+            # hashes, the others get the error
+            self.md5s = {}
+            try:
+                for info in archive:
+                    if info.isfile():
+                        with contextlib.closing(
+                                archive.extractfile(info)) as member_file:
+                            self.md5s[info.name] = md5_file(member_file)
+            except READ_ERRORS as err:
+                self.md5_error = err
+        if member in self.md5s:
+            return self.md5s[member]
+        if self.md5_error is not None:
+            raise self.md5_error
+        raise IOError("No file {0} in {1}".format(member, archive_path))
+
+    def _get_archive(self, archive_path):
+        """
+        Return the archive at archive_path, opening it if it is not the
+        open archive
+        """
+        if archive_path != self.archive_path:
+            self.close()
+            if archive_path.lower().endswith(ZIP_EXTENSIONS):
+                self.archive = zipfile.ZipFile(archive_path)
+            else:
+                self.archive = tarfile.open(archive_path)
+            self.archive_path = archive_path
+        return self.archive
+
+    def close(self):
+        """
+        Close the open archive and drop the hashes of its members
+        """
+        if self.archive is not None:
+            self.archive.close()
+        self.archive_path = None
+        self.archive = None
+        self.md5s = None
+        self.md5_error = None
@@ -39,7 +39,61 @@ except ImportError:
             sys.exit(2)
 
 
-def get_connection(db_path):
+# Named sets of PRAGMA settings applied by get_connection. The settings
+# are applied in order, page_size has to come before journal_mode and only
+# takes effect on newly created databases.
+PRAGMA_PROFILES = {
+    # rollback journal, fsync on every commit (the sqlite defaults)
+    'safe': [
+        ('journal_mode', 'DELETE'),
+        ('synchronous', 'FULL'),
+    ],
+    # write ahead log, fsync only at checkpoints, large page cache
+    'fast-import': [
+        ('page_size', 8192),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -262144),
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 268435456),
+    ],
+    # large cache and memory mapping for read heavy queries, no writes
+    'readonly-analytics': [
+        ('cache_size', -524288),
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 1073741824),
+        ('query_only', 'ON'),
+    ],
+}
+
+
+# profiles whose connections can not write to the database
+READONLY_PROFILES = ['readonly-analytics']
+
+
+def get_profiles(writable=False):
+    """
+    Return the sorted names of the PRAGMA profiles, only those allowing
+    writes to the database if writable is True
+    """
+    return sorted(profile for profile in PRAGMA_PROFILES
+                  if not (writable and profile in READONLY_PROFILES))
+
+
+def apply_pragma_profile(connection, profile):
+    """
+    Apply the PRAGMA settings of the named profile to the connection
+    """
+    try:
+        pragmas = PRAGMA_PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown PRAGMA profile: {0}".format(profile))
+
+    for name, value in pragmas:
+        connection.execute('PRAGMA {0} = {1}'.format(name, value))
+
+
+def get_connection(db_path, profile=None):
     connection = spatialite.connect(db_path)
     if LOAD_AS_EXTENSION:
         # print('spatialite loaded as sqlite extension')
@@ -68,4 +122,7 @@ def get_connection(db_path):
             print("Unable to load spatialite sqlite3 extension")
             sys.exit(0)
 
+    if profile is not None:
+        apply_pragma_profile(connection, profile)
+
     return connection
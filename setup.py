@@ -40,6 +40,7 @@ setup(description='gpx2spatialite',
       author_email='mail@petervasil.net',
       version=__version__,
       install_requires=['gpxpy'],
+      extras_require={'numpy': ['numpy'], 'lxml': ['lxml']},
       packages=['gpx2spatialite'],
       entry_points={
           'console_scripts': [
@@ -0,0 +1,122 @@
+import pytest
+import os
+from datetime import datetime
+from gpx2spatialite import cache
+from gpx2spatialite import gpx
+from gpx2spatialite import helper
+from gpx2spatialite import segment
+
+
+def get_location(lon, lat):
+    return int(lon * 10 + lat) % 7
+
+
+@pytest.mark.usefixtures("gpx_path")
+class TestCache:
+
+    @pytest.mark.parametrize('filename', ['file.gpx', 'gpx10_speed.gpx',
+                                          'gpx11_extensions.gpx'])
+    def test_extractpoints(self, filename, tmpdir):
+        filepath = os.path.abspath(os.path.join('tests/data', filename))
+        parse_cache = cache.ParseCache(str(tmpdir))
+        md5hash = helper.getmd5(filepath)
+
+        def extract():
+            trkpts, trklines, first, last, wpts, segs = gpx.extractpoints(
+                filepath, get_location, False, True, 'stream', parse_cache)
+            # segment uuids are new on every parse
+            return ([line[1:] for line in trkpts],
+                    [line[1:] for line in trklines],
+                    first, last, str(first), str(last), wpts,
+                    [str(line[3]) for line in trkpts])
+
+        expected = extract()
+        assert os.path.isfile(parse_cache.get_path(md5hash))
+
+        records = list(parse_cache.load(md5hash))
+        assert records[-1][0] == 'timestamps'
+        assert all(segment.loc.tolist() == [-1] * len(segment)
+                   for kind, segment in records if kind == 'segment')
+
+        # read from the cache
+        assert extract() == expected
+
+    def test_mixed_offsets(self, tmpdir):
+        parse_cache = cache.ParseCache(str(tmpdir))
+        seg = segment.TrackSegment('segment-uuid')
+        for time in ('2012-03-17T14:46:19+02:00', '2012-03-17T12:47:19Z',
+                     datetime(2012, 3, 17, 12, 50, 19), None):
+            seg.append(13.4, 52.5, 0, time, 0, 0)
+        writer = parse_cache.writer('mixed')
+        writer.add_segment(seg)
+        writer.commit(None, None)
+
+        kind, cached = next(parse_cache.load('mixed'))
+        assert kind == 'segment'
+        assert cached.get_timestamps() == seg.get_timestamps()
+        assert cached.get_times() == seg.get_times()
+
+    def test_parse_error_not_cached(self, tmpdir):
+        filepath = os.path.abspath('tests/data/malformed.gpx')
+        parse_cache = cache.ParseCache(str(tmpdir))
+
+        gpx.extractpoints(filepath, None, False, False, 'stream',
+                          parse_cache)
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_corrupt_entry(self, gpx_path, tmpdir):
+        parse_cache = cache.ParseCache(str(tmpdir))
+        md5hash = helper.getmd5(gpx_path)
+        gpx.extractpoints(gpx_path, None, False, False, 'stream',
+                          parse_cache)
+
+        path = parse_cache.get_path(md5hash)
+        with open(path, 'r+b') as entry_file:
+            entry_file.seek(len(cache.MAGIC) + 4)
+            entry_file.write(b'\xff')
+
+        assert parse_cache.load(md5hash) is None
+        assert not os.path.exists(path)
+        with pytest.raises(cache.CacheError):
+            cache.read_records(b'not a cache entry')
+
+    def test_evict(self, tmpdir):
+        parse_cache = cache.ParseCache(str(tmpdir), max_size=250)
+        for index, md5hash in enumerate(['a', 'b', 'c']):
+            with open(parse_cache.get_path(md5hash), 'wb') as entry_file:
+                entry_file.write(b'x' * 100)
+            os.utime(parse_cache.get_path(md5hash), (index, index))
+        # a was read last
+        os.utime(parse_cache.get_path('a'), (10, 10))
+
+        assert parse_cache.evict() == 1
+        assert sorted(os.listdir(str(tmpdir))) == ['a.g2sc', 'c.g2sc']
+
+    def test_add_entry(self, tmpdir, monkeypatch):
+        parse_cache = cache.ParseCache(str(tmpdir), max_size=250)
+        listdir = os.listdir
+        calls = []
+
+        def count_listdir(path):
+            calls.append(path)
+            return listdir(path)
+
+        monkeypatch.setattr(cache.os, 'listdir', count_listdir)
+
+        def add(md5hash, mtime):
+            with open(parse_cache.get_path(md5hash), 'wb') as entry_file:
+                entry_file.write(b'x' * 100)
+            os.utime(parse_cache.get_path(md5hash), (mtime, mtime))
+            parse_cache.add_entry(100)
+
+        # the directory is listed for the first entry only
+        add('a', 1)
+        add('b', 2)
+        assert len(calls) == 1
+        assert parse_cache.total_size == 200
+
+        # and again once entries have to be removed
+        add('c', 3)
+        assert len(calls) == 2
+        assert parse_cache.total_size == 200
+        assert sorted(listdir(str(tmpdir))) == ['b.g2sc', 'c.g2sc']
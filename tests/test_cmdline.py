@@ -1,5 +1,8 @@
+import os
 import pytest
+import zipfile
 from gpx2spatialite import cmdline
+from gpx2spatialite import sources
 
 
 @pytest.mark.usefixtures("gpx_path", "dummy_files")
@@ -47,3 +50,37 @@ class TestCmdline:
         assert cmdline.checkfile(gpx_path)
         assert cmdline.checkfile(tmp_dir)
         assert cmdline.checkfile('nonexistent-file') is False
+
+    def test_read_filepaths_compressed(self, gpx_path, tmpdir):
+        tmpdir.join('track1.gpx.gz').write('')
+        tmpdir.join('track2.gpx.xz').write('')
+        tmpdir.join('notes.txt.gz').write('')
+        zip_path = str(tmpdir.join('tracks.zip'))
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            zip_file.write(gpx_path, 'track3.gpx')
+            zip_file.write(gpx_path, 'track3.txt')
+
+        expected = [str(tmpdir.join('track1.gpx.gz')),
+                    zip_path + '/track3.gpx']
+        # .xz files are only read with the lzma module of Python 3
+        if sources.lzma is not None:
+            expected.append(str(tmpdir.join('track2.gpx.xz')))
+        actual = cmdline.read_filepaths([str(tmpdir)], ".gpx")
+        assert sorted(expected) == sorted(actual)
+
+        actual = cmdline.read_filepaths([zip_path], ".gpx")
+        assert [zip_path + '/track3.gpx'] == actual
+
+    def test_sort_filepaths(self, tmpdir):
+        paths = []
+        for name, mtime in (('b.gpx', 300), ('c.gpx', 100), ('a.gpx', 200)):
+            tmpdir.join(name).write('')
+            os.utime(str(tmpdir.join(name)), (mtime, mtime))
+            paths.append(str(tmpdir.join(name)))
+
+        assert cmdline.sort_filepaths(paths, 'input') == paths
+        assert cmdline.sort_filepaths(paths, 'path') == sorted(paths)
+        assert cmdline.sort_filepaths(paths, 'mtime') == \
+            [paths[1], paths[2], paths[0]]
+        with pytest.raises(ValueError):
+            cmdline.sort_filepaths(paths, 'size')
@@ -1,10 +1,12 @@
 import pytest
 import os.path
+import re
 from functools import partial
 from gpx2spatialite import db
 from gpx2spatialite import db_helper
 from gpx2spatialite import helper
 from gpx2spatialite import gpx
+from gpx2spatialite import spatialite_finder
 
 
 @pytest.mark.usefixtures("gpx_path", "database")
@@ -24,7 +26,9 @@ class TestDb:
         cursor = database.cursor
         extracted_pts = gpx.extractpoints(gpx_path, skip_wpts=True)
 
-        db.enterfile(gpx_path, cursor, 1, extracted_pts[2], extracted_pts[3])
+        file_uid = db.enterfile(gpx_path, cursor, 1, extracted_pts[2],
+                                extracted_pts[3])
+        assert file_uid == db.get_currentfileid(cursor)
 
         sql = "select * from files"
         res = cursor.execute(sql)
@@ -32,6 +36,20 @@ class TestDb:
 
         assert test_file_row[1] == os.path.basename(gpx_path)
 
+    def test_update_file_timestamps(self, gpx_path, database):
+        cursor = database.cursor
+        extracted_pts = gpx.extractpoints(gpx_path, skip_wpts=True)
+
+        file_uid = db.enterfile(gpx_path, cursor, 1, None, None)
+        db.update_file_timestamps(cursor, file_uid, extracted_pts[2],
+                                  extracted_pts[3])
+
+        sql = ("select first_timestamp, last_timestamp from files "
+               "where file_uid = ?")
+        res = cursor.execute(sql, (file_uid,))
+        assert res.fetchone() == (str(extracted_pts[2]),
+                                  str(extracted_pts[3]))
+
     def get_file_and_user(self, gpx_path, database):
         cursor = database.cursor
         md5 = helper.getmd5(os.path.expanduser(gpx_path))
@@ -47,7 +65,9 @@ class TestDb:
         extracted_pts = gpx.extractpoints(gpx_path)
 
         fileid, userid = self.get_file_and_user(gpx_path, database)
-        db.enterpoints(cursor, userid, extracted_pts[0], fileid, None)
+        num_inserted = db.enterpoints(cursor, userid, extracted_pts[0],
+                                      fileid, None)
+        assert num_inserted == 4
 
         sql = "select *, astext(geom) from trackpoints"
         res = cursor.execute(sql)
@@ -69,6 +89,30 @@ class TestDb:
         assert trkpt_rows[1][10] is None
         assert trkpt_rows[1][12] == "POINT(13.45717 52.511357)"
 
+    def test_enter_segment_points(self, gpx_path, database):
+        cursor = database.cursor
+        segment = [value for kind, value in gpx.iterextract(gpx_path)
+                   if kind == 'segment'][0]
+
+        fileid, userid = self.get_file_and_user(gpx_path, database)
+        duplicates = db.get_segment_duplicates(cursor, userid, segment)
+        assert duplicates == set(range(4))
+        # timestamps repeated within a segment
+        assert db.find_duplicates(set(['a']), ['a', 'b', 'b', 'c']) == \
+            set([0, 2])
+
+        num_inserted = db.enter_segment_points(cursor, userid, segment,
+                                               fileid, -1, duplicates)
+        assert num_inserted == 0
+
+        # only the filtered duplicates are left out
+        with pytest.raises(spatialite_finder.spatialite.IntegrityError):
+            db.enter_segment_points(cursor, userid, segment, fileid, -1)
+
+        timestamps = segment.get_timestamps()
+        assert db.get_duplicates(cursor, userid, ['None', 'None'] +
+                                 timestamps[:1]) == set([1, 2])
+
     def test_entertracklines(self, gpx_path, database):
         cursor = database.cursor
         extracted_pts = gpx.extractpoints(gpx_path)
@@ -115,6 +159,41 @@ class TestDb:
         assert wpt_row[7] is None
         assert wpt_row[9] == "POINT(-121.17042 37.085751)"
 
+    def test_insert_segments(self, database):
+        cursor = database.cursor
+        seg_uuids = ["segment-uuid-1", "segment-uuid-2"]
+        segments_dict = db.insert_segments(cursor, seg_uuids)
+
+        sql = "select trkseg_uid from tracksegments where trkseg_uuid = ?"
+        for seg_uuid in seg_uuids:
+            res = cursor.execute(sql, (seg_uuid,))
+            assert segments_dict[seg_uuid] == res.fetchone()[0]
+
+        assert segments_dict["segment-uuid-2"] == db.get_lasttrkseg(cursor)
+
+    def test_check_if_gpxfile_exists(self, gpx_path, database):
+        cursor = database.cursor
+        md5 = helper.getmd5(gpx_path)
+
+        assert db.check_if_gpxfile_exists(cursor, gpx_path) is True
+        assert db.check_if_gpxfile_exists(cursor, gpx_path, md5) is True
+        assert db.check_if_gpxfile_exists(cursor, gpx_path, "0" * 32) is False
+
+    def test_manifest(self, gpx_path, database):
+        cursor = database.cursor
+        md5 = helper.getmd5(gpx_path)
+        file_uid = db.get_file_uid(cursor, md5)
+        assert file_uid != -1
+        assert db.get_file_uid(cursor, "0" * 32) == -1
+
+        file_stat = helper.get_file_stat(gpx_path)
+        db.enter_manifest(cursor, gpx_path, file_stat, md5, file_uid)
+        db.enter_manifest(cursor, "/not/imported.gpx", (1, 2, 3), "0" * 32,
+                          None)
+
+        manifest = db.get_manifest(cursor)
+        assert manifest == {gpx_path: file_stat}
+
     def test_check_if_table_exists(self, database):
         table_exists_func = \
             partial(db_helper.check_if_table_exists, database.conn)
@@ -128,3 +207,124 @@ class TestDb:
 
         assert len(loc_trks_func(False)) == 4
         assert len(loc_trks_func(True)) == 0
+
+    def get_query_plan(self, cursor, sql):
+        # older sqlite versions write SCAN TABLE and SEARCH TABLE
+        return [re.sub(r'^(SCAN|SEARCH) TABLE ', r'\1 ', row[-1])
+                for row in cursor.execute("EXPLAIN QUERY PLAN " + sql)]
+
+    @pytest.mark.parametrize('unknown_only', [False, True])
+    def test_cityid_trackpoint_pairs_plan(self, database, unknown_only):
+        sql = db.get_cityid_trackpoint_pairs_sql(unknown_only)
+        plan = self.get_query_plan(database.cursor, sql)
+
+        # citydefs drive the join, trackpoints are only reached through
+        # the R*Tree of their spatial index
+        assert plan[0].startswith("SCAN citydefs")
+        assert plan[1].startswith("SCAN idx")
+        assert "VIRTUAL TABLE INDEX" in plan[1]
+        assert plan[2].startswith(
+            "SEARCH trackpoints USING INTEGER PRIMARY KEY")
+        assert not any(line.startswith("SCAN trackpoints") for line in plan)
+
+        sql = db.get_cityid_trackpoint_pairs_sql(unknown_only, False)
+        plan = self.get_query_plan(database.cursor, sql)
+        assert not any("VIRTUAL TABLE" in line for line in plan)
+
+    def test_cityid_trackpoint_pairs_without_index(self, database):
+        cursor = database.cursor
+        for unknown_only in (False, True):
+            sql = db.get_cityid_trackpoint_pairs_sql(unknown_only)
+            with_index = cursor.execute(sql).fetchall()
+            sql = db.get_cityid_trackpoint_pairs_sql(unknown_only, False)
+            assert cursor.execute(sql).fetchall() == with_index
+
+    def test_cityid_trackpoint_pairs_overlapping(self, tmpdir):
+        db_path = str(tmpdir.join('overlap.sqlite'))
+        db_helper.create_new_db(db_path)
+        conn = spatialite_finder.get_connection(db_path)
+        cursor = conn.cursor()
+
+        for city, ring in (
+                ('Unknown', '0 0, 0 0, 0 0, 0 0, 0 0'),
+                ('Outer', '13 52, 13 53, 14 53, 14 52, 13 52'),
+                ('Inner', '13.3 52.4, 13.3 52.6, 13.5 52.6, 13.5 52.4, '
+                          '13.3 52.4')):
+            sql = ("INSERT INTO citydefs (city, country, geom) "
+                   "VALUES (?, 'DE', GeomFromText(?, 4326))")
+            cursor.execute(sql, (city, 'POLYGON(({0}))'.format(ring)))
+        for index, point in enumerate(('13.4 52.5', '13.8 52.8', '20 20')):
+            sql = ("INSERT INTO trackpoints (ele, utctimestamp, file_uid, "
+                   "user_uid, citydef_uid, geom) "
+                   "VALUES (0, ?, 1, 1, 1, GeomFromText(?, 4326))")
+            cursor.execute(sql, (str(index),
+                                 'POINT({0})'.format(point)))
+
+        # one row per trackpoint, the first point lies in both citydefs
+        # and gets the lower citydef_uid
+        expected = [(2, 1), (2, 2)]
+        assert sorted(db.get_cityid_trackpoint_pairs(cursor, False)) == \
+            expected
+        sql = db.get_cityid_trackpoint_pairs_sql(False, False)
+        assert sorted(cursor.execute(sql).fetchall()) == expected
+
+        # a disabled index is not used, even if its R*Tree is still there
+        cursor.execute("SELECT DisableSpatialIndex('trackpoints', 'geom')")
+        cursor.execute("DELETE FROM idx_trackpoints_geom")
+        assert db_helper.check_if_table_exists(conn, "idx_trackpoints_geom")
+        assert sorted(db.get_cityid_trackpoint_pairs(cursor, False)) == \
+            expected
+
+        conn.close()
+
+    def test_get_location_func(self, database):
+        citydefs = db.get_citydefs(database.cursor)
+        assert [citydef_uid for citydef_uid, polygons in citydefs] == [1, 2]
+
+        get_loc_func = db.get_location_func(database.cursor)
+        for lon, lat in ((13.4, 52.5), (13.10156, 52.5), (0, 0), (5, 5)):
+            assert get_loc_func(lon, lat) == \
+                db.get_location(database.cursor, lon, lat)
+        assert get_loc_func(13.4, 52.5) == 2
+
+    def test_geom_from_func(self):
+        assert db.geom_from_func("Point(13.4 52.5)") == "GeomFromText"
+        assert db.geom_from_func(helper.point_wkb(13.4, 52.5)) == \
+            "GeomFromWKB"
+
+    def test_disable_and_rebuild_spatial_indexes(self, tmpdir):
+        db_path = str(tmpdir.join('bulk.sqlite'))
+        db_helper.create_new_db(db_path)
+        conn = spatialite_finder.get_connection(db_path)
+
+        assert db_helper.get_disabled_spatial_indexes(conn) == []
+
+        db_helper.disable_spatial_indexes(conn)
+        assert db_helper.get_disabled_spatial_indexes(conn) == \
+            db_helper.SPATIAL_INDEX_TABLES
+        assert not db_helper.check_if_table_exists(conn,
+                                                   "idx_trackpoints_geom")
+
+        db_helper.rebuild_spatial_indexes(conn)
+        assert db_helper.get_disabled_spatial_indexes(conn) == []
+        assert db_helper.check_if_table_exists(conn, "idx_trackpoints_geom")
+
+        conn.close()
+
+    def test_apply_pragma_profile(self, tmpdir):
+        db_path = str(tmpdir.join('profile.sqlite'))
+        conn = spatialite_finder.get_connection(db_path, 'fast-import')
+
+        res = conn.execute("PRAGMA journal_mode")
+        assert res.fetchone()[0] == "wal"
+        res = conn.execute("PRAGMA synchronous")
+        assert res.fetchone()[0] == 1
+
+        spatialite_finder.apply_pragma_profile(conn, 'safe')
+        res = conn.execute("PRAGMA journal_mode")
+        assert res.fetchone()[0] == "delete"
+
+        with pytest.raises(ValueError):
+            spatialite_finder.apply_pragma_profile(conn, 'no-such-profile')
+
+        conn.close()
@@ -1,4 +1,7 @@
 import pytest
+import gzip
+import os.path
+import zipfile
 from datetime import datetime
 from gpx2spatialite import gpx
 
@@ -20,3 +23,159 @@ class TestGpx:
         assert len(extracted_points[1]) == 1
 
         assert len(extracted_points[4]) == 2
+
+    def test_extractpoints_wkb(self, gpx_path):
+        wkt_points = gpx.extractpoints(gpx_path)
+        wkb_points = gpx.extractpoints(gpx_path, wkb=True)
+
+        for wkt_pt, wkb_pt in zip(wkt_points[0], wkb_points[0]):
+            assert wkt_pt[1:7] == wkb_pt[1:7]
+            assert isinstance(wkb_pt[7], bytes)
+
+        assert isinstance(wkb_points[1][0][6], bytes)
+        assert isinstance(wkb_points[4][0][5], bytes)
+
+    def test_extractpoints_stream_parser(self, gpx_path):
+        gpxpy_points = gpx.extractpoints(gpx_path)
+        stream_points = gpx.extractpoints(gpx_path, parser='stream')
+
+        # segment uuids are random, compare everything else
+        assert [p[1:] for p in gpxpy_points[0]] == \
+            [p[1:] for p in stream_points[0]]
+        assert [line[1:] for line in gpxpy_points[1]] == \
+            [line[1:] for line in stream_points[1]]
+        assert gpxpy_points[2:5] == stream_points[2:5]
+        assert len(stream_points[5]) == 1
+
+    def test_iterextract(self, gpx_path):
+        extracted_points = gpx.extractpoints(gpx_path)
+
+        for parser in gpx.PARSERS:
+            items = list(gpx.iterextract(gpx_path, parser=parser))
+            segments = [value for kind, value in items if kind == 'segment']
+            assert len(segments) == 1
+            assert items[-1][0] == 'timestamps'
+
+            assert [p[1:] for p in segments[0].trackpoints()] == \
+                [p[1:] for p in extracted_points[0]]
+            assert segments[0].trackline()[1:] == \
+                extracted_points[1][0][1:]
+            assert items[-1][1] == tuple(extracted_points[2:4])
+
+    def test_extractpoints_compressed(self, gpx_path, tmpdir):
+        gz_path = str(tmpdir.join('file.gpx.gz'))
+        with open(gpx_path, 'rb') as gpx_file:
+            with gzip.open(gz_path, 'wb') as gz_file:
+                gz_file.write(gpx_file.read())
+
+        for parser in gpx.PARSERS:
+            plain_points = gpx.extractpoints(gpx_path, parser=parser)
+            gz_points = gpx.extractpoints(gz_path, parser=parser)
+            assert [p[1:] for p in plain_points[0]] == \
+                [p[1:] for p in gz_points[0]]
+            assert plain_points[2:5] == gz_points[2:5]
+
+    def test_extractpoints_corrupt(self, gpx_path, tmpdir):
+        with open(gpx_path, 'rb') as gpx_file:
+            content = gpx_file.read()
+
+        # the second half of the compressed file is missing
+        gz_path = str(tmpdir.join('truncated.gpx.gz'))
+        with gzip.open(gz_path, 'wb') as gz_file:
+            gz_file.write(content)
+        with open(gz_path, 'rb') as gz_file:
+            compressed = gz_file.read()
+        with open(gz_path, 'wb') as gz_file:
+            gz_file.write(compressed[:len(compressed) // 2])
+
+        # the header of one member and the compressed data of the other
+        # are overwritten
+        zip_path = str(tmpdir.join('corrupt.zip'))
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('header.gpx', content)
+            zip_file.writestr('data.gpx', content)
+            header_info = zip_file.getinfo('header.gpx')
+            data_info = zip_file.getinfo('data.gpx')
+        with open(zip_path, 'r+b') as zip_file:
+            zip_file.seek(header_info.header_offset)
+            zip_file.write(b'\xff' * 4)
+            zip_file.seek(data_info.header_offset + 30 +
+                          len(data_info.filename) + 10)
+            zip_file.write(b'\xff' * 20)
+
+        for filepath in (gz_path, zip_path + '/header.gpx',
+                         zip_path + '/data.gpx'):
+            for parser in gpx.PARSERS:
+                items = list(gpx.iterextract(filepath, parser=parser))
+                assert items[-1] == ('timestamps', (0, 0))
+
+    def test_iterparse_items_malformed(self, tmpdir):
+        gpx_file = tmpdir.join('malformed.gpx')
+        gpx_file.write('<gpx version="1.1"><trk><trkseg>'
+                       '<trkpt lat="52.5" lon="13.4"></trkpt>')
+
+        with pytest.raises(gpx.GPXParseError):
+            list(gpx.iterparse_items(str(gpx_file)))
+
+        extracted_points = gpx.extractpoints(str(gpx_file), parser='stream')
+        assert extracted_points == ([], [], 0, 0, [], [])
+
+    @pytest.mark.skipif(gpx.lxml_etree is None, reason="needs lxml")
+    def test_lxml_iterparse_drops_finished_elements(self, tmpdir,
+                                                    monkeypatch):
+        gpx_file = tmpdir.join('many.gpx')
+        gpx_file.write(
+            '<gpx version="1.1"><metadata><name>tracks</name></metadata>' +
+            '<wpt lat="52.5" lon="13.4"><name>wpt</name></wpt>' * 3 +
+            '<rte><rtept lat="52.5" lon="13.4"/></rte>' +
+            ('<trk><name>trk</name>' +
+             ('<trkseg>' + '<trkpt lat="52.5" lon="13.4"/>' * 3 +
+              '</trkseg>') * 2 + '</trk>') * 3 +
+            '</gpx>')
+
+        parsers = []
+        iterparse = gpx.lxml_etree.iterparse
+
+        def recording_iterparse(*args, **kwargs):
+            parsers.append(iterparse(*args, **kwargs))
+            return parsers[-1]
+
+        monkeypatch.setattr(gpx.lxml_etree, 'iterparse', recording_iterparse)
+        items = list(gpx.iterparse_items(str(gpx_file), parser='lxml'))
+
+        assert [kind for kind, item in items] == ['wpt'] * 3 + ['trkseg'] * 6
+        # every finished element has been removed from the tree
+        assert len(parsers[0].root) == 0
+
+
+CONFORMANCE_FILES = ['file.gpx', 'gpx10_speed.gpx', 'gpx11_extensions.gpx',
+                     'no_namespace.gpx', 'bad_elevation.gpx',
+                     'malformed.gpx']
+
+
+def strip_uuids(extracted_points):
+    """segment uuids are random, keep everything else"""
+    trkpts, trklines, first, last, wpts, segs = extracted_points
+    return ([p[1:] for p in trkpts], [line[1:] for line in trklines], first,
+            last, wpts, len(segs))
+
+
+class TestParserConformance:
+    """Every parser backend has to give the same results as gpxpy"""
+
+    @pytest.mark.parametrize("parser", gpx.PARSERS)
+    @pytest.mark.parametrize("filename", CONFORMANCE_FILES)
+    def test_extractpoints(self, parser, filename):
+        file_path = os.path.abspath(os.path.join("tests/data", filename))
+
+        expected = strip_uuids(gpx.extractpoints(file_path))
+        actual = strip_uuids(gpx.extractpoints(file_path, parser=parser))
+        assert expected == actual
+
+    def test_get_parser(self, monkeypatch):
+        assert gpx.get_parser('stream') == 'stream'
+        with pytest.raises(ValueError):
+            gpx.get_parser('sax')
+
+        monkeypatch.setattr(gpx, 'lxml_etree', None)
+        assert gpx.get_parser('lxml') == 'gpxpy'
@@ -0,0 +1,119 @@
+import os
+import sys
+import pytest
+from gpx2spatialite import gpx2spatialite
+
+
+@pytest.mark.usefixtures("gpx_path")
+class TestGpx2spatialite:
+
+    def test_parse_files(self, gpx_path):
+        filepaths = [gpx_path,
+                     os.path.abspath("tests/data/gpx11_extensions.gpx"),
+                     os.path.abspath("tests/data/no_namespace.gpx"),
+                     os.path.abspath("tests/data/file.gpx")]
+        args_dict = {'jobs': 2, 'dbpath': 'unused', 'skip_locs': True,
+                     'quiet': True, 'wkb': True, 'parser': 'stream',
+                     'cache_dir': None}
+        # the manifest skips the second file
+        manifest = {filepaths[1]: gpx2spatialite.helper.get_file_stat(
+            filepaths[1])}
+
+        def get_files(gpx_files):
+            files = []
+            for filepath, file_stat, md5hash, items in gpx_files:
+                files.append((filepath, file_stat, md5hash,
+                              [(kind, value.trackpoints(True))
+                               if kind == 'segment' else (kind, value)
+                               for kind, value in items]))
+            return files
+
+        expected = get_files(gpx2spatialite.read_files(
+            filepaths, manifest, None, args_dict))
+        actual = get_files(gpx2spatialite.parse_files(
+            filepaths, manifest, args_dict))
+
+        assert [f[0] for f in actual] == \
+            [filepaths[0], filepaths[2], filepaths[3]]
+        # the points get new segment uuids on every parse
+        for files in (expected, actual):
+            for filepath, file_stat, md5hash, items in files:
+                for kind, value in items:
+                    if kind == 'segment':
+                        for line in value:
+                            line[0] = None
+        assert expected == actual
+
+    def test_parse_files_in_chunks(self, gpx_path, monkeypatch):
+        # every worker gets two files, sent one point at a time
+        monkeypatch.setattr(gpx2spatialite, 'CHUNK_POINTS', 1)
+        filepaths = [gpx_path,
+                     os.path.abspath("tests/data/gpx11_extensions.gpx"),
+                     os.path.abspath("tests/data/file.gpx"),
+                     os.path.abspath("tests/data/no_namespace.gpx")]
+        args_dict = {'jobs': 2, 'dbpath': 'unused', 'skip_locs': True,
+                     'quiet': True, 'wkb': False, 'parser': 'stream',
+                     'cache_dir': None}
+
+        def get_kinds(items):
+            return [kind for kind, value in items]
+
+        expected = [get_kinds(items) for filepath, file_stat, md5hash, items
+                    in gpx2spatialite.read_files(filepaths, {}, None,
+                                                 args_dict)]
+
+        actual = []
+        for index, (filepath, file_stat, md5hash, items) in enumerate(
+                gpx2spatialite.parse_files(filepaths, {}, args_dict)):
+            # the items of files which are not entered are dropped
+            if index == 0:
+                actual.append(None)
+            elif index == 2:
+                next(items)
+                actual.append(None)
+            else:
+                actual.append(get_kinds(items))
+
+        assert actual == [None, expected[1], None, expected[3]]
+        assert len(expected[1]) == 3
+
+    def test_parse_files_worker_error(self, gpx_path, monkeypatch, capsys):
+        filepaths = [os.path.abspath("tests/data/no_namespace.gpx"),
+                     gpx_path]
+        args_dict = {'jobs': 2, 'dbpath': 'unused', 'skip_locs': True,
+                     'quiet': True, 'wkb': False, 'parser': 'stream',
+                     'cache_dir': None}
+        iterextract = gpx2spatialite.gpx.iterextract
+
+        def failing_iterextract(filepath, *args):
+            if filepath == filepaths[0]:
+                raise ValueError('broken file')
+            return iterextract(filepath, *args)
+
+        # the workers are forked with the patched function
+        monkeypatch.setattr(gpx2spatialite.gpx, 'iterextract',
+                            failing_iterextract)
+
+        files = [[kind for kind, value in items]
+                 for filepath, file_stat, md5hash, items
+                 in gpx2spatialite.parse_files(filepaths, {}, args_dict)]
+
+        # the failed file ends like a malformed one, the next is parsed
+        assert files[0] == ['timestamps']
+        assert files[1][-1] == 'timestamps' and 'segment' in files[1]
+        assert 'broken file' in capsys.readouterr()[0]
+
+    @pytest.mark.parametrize('argv', [
+        ['import', '-p', 'readonly-analytics', '-d', 'db.sqlite', '-u',
+         'user', 'file.gpx'],
+        ['update_locs', '-p', 'readonly-analytics', 'db.sqlite'],
+        ['citydefs', '-p', 'readonly-analytics', '-i', 'citydefs.sql',
+         'db.sqlite'],
+    ])
+    def test_readonly_profile_rejected(self, argv, monkeypatch, capsys):
+        monkeypatch.setattr(sys, 'argv', ['gpx2spatialite'] + argv)
+        with pytest.raises(SystemExit) as excinfo:
+            gpx2spatialite.main()
+        assert excinfo.value.code == 2
+        out, err = capsys.readouterr()
+        assert 'readonly-analytics' in out + err
@@ -1,6 +1,12 @@
 import pytest
+import gzip
 import os.path
+import struct
+from array import array
+from datetime import timedelta
+import gpxpy
 from gpx2spatialite import helper
+from gpx2spatialite import segment
 
 
 @pytest.mark.usefixtures("gpx_path")
@@ -11,6 +17,29 @@ class TestHelper:
 
         assert md5 == "17228581bc70c73205e3031041ab1656"
 
+    def test_getmd5_compressed(self, gpx_path, tmpdir):
+        gz_path = str(tmpdir.join('file.gpx.gz'))
+        with open(gpx_path, 'rb') as gpx_file:
+            with gzip.open(gz_path, 'wb') as gz_file:
+                gz_file.write(gpx_file.read())
+
+        assert helper.getmd5(gz_path) == helper.getmd5(gpx_path)
+
+    def test_getmd5_corrupt(self, gpx_path, tmpdir):
+        gz_path = str(tmpdir.join('truncated.gpx.gz'))
+        with open(gpx_path, 'rb') as gpx_file:
+            with gzip.open(gz_path, 'wb') as gz_file:
+                gz_file.write(gpx_file.read())
+        with open(gz_path, 'r+b') as gz_file:
+            gz_file.truncate(os.path.getsize(gz_path) // 2)
+
+        zip_path = str(tmpdir.join('corrupt.zip'))
+        with open(zip_path, 'wb') as zip_file:
+            zip_file.write(b'PK\x03\x04 not a zip file')
+
+        assert helper.getmd5(gz_path) == ''
+        assert helper.getmd5(zip_path + '/file.gpx') == ''
+
     def test_get_course(self):
         lat1 = 52.5113534275
         lon1 = 13.4571944922
@@ -20,3 +49,99 @@ class TestHelper:
         course_expected = -77.1362263930987
         course_actual = helper.get_course(lat1, lon1, lat2, lon2)
         assert course_actual == course_expected
+
+    def test_get_courses(self, monkeypatch):
+        lats = [52.5113534275, 52.5113568641, 90.0, 52.0, -90.0, 0.0, 0.0]
+        lons = [13.4571944922, 13.4571697656, 13.0, 13.0, 13.0, 179.0, -179.0]
+        expected = [helper.get_course(lats[i], lons[i], lats[i + 1],
+                                      lons[i + 1])
+                    for i in range(len(lats) - 1)]
+
+        courses = helper.get_courses(lats, lons)
+        assert list(courses) == pytest.approx(expected, abs=1e-9)
+        assert courses[2] == 180.0
+        assert courses[4] == 0.0
+        assert all(-180 < course <= 180 for course in courses)
+        assert list(helper.get_courses(lats[:1], lons[:1])) == []
+
+        # without NumPy the scalar version is used
+        monkeypatch.setattr(helper, 'numpy', None)
+        assert list(helper.get_courses(lats, lons)) == expected
+
+    @pytest.mark.parametrize("use_numpy", [True, False])
+    def test_get_segment_metrics(self, gpx_path, monkeypatch, use_numpy):
+        if not use_numpy:
+            monkeypatch.setattr(helper, 'numpy', None)
+        with open(gpx_path) as gpx_file:
+            gpx_segment = gpxpy.parse(gpx_file).tracks[0].segments[0]
+        points = gpx_segment.points
+
+        speeds, length_m, time_sec = helper.get_segment_metrics(
+            [p.latitude for p in points], [p.longitude for p in points],
+            [p.elevation for p in points],
+            [segment.to_epoch(p.time) for p in points], [0] * len(points))
+
+        expected_speeds = [0] + [p.speed_between(lastpoint) for lastpoint, p
+                                 in zip(points, points[1:])]
+        assert list(speeds) == pytest.approx(expected_speeds, rel=1e-9)
+        assert length_m == pytest.approx(gpx_segment.length_2d(), rel=1e-9)
+        assert time_sec == gpx_segment.get_duration()
+
+        # recorded speeds are kept
+        speeds = helper.get_segment_metrics(
+            [52.5, 52.6], [13.4, 13.4], [0, 0], [0, 10], [1.5, 2.5])[0]
+        assert list(speeds) == [1.5, 2.5]
+
+        # points more than 0.2 degrees apart use the haversine distance
+        speeds, length_m, time_sec = helper.get_segment_metrics(
+            [52.0, 53.0], [13.0, 13.5], [10, 20], [0, 100], [0, 0])
+        distance = gpxpy.geo.haversine_distance(53.0, 13.5, 52.0, 13.0)
+        assert length_m == pytest.approx(distance, rel=1e-9)
+        assert speeds[1] == pytest.approx(distance / 100, rel=1e-9)
+        assert time_sec == 100
+
+    def test_chunks(self):
+        assert list(helper.chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+        assert list(helper.chunks(range(4), 2)) == [[0, 1], [2, 3]]
+        assert list(helper.chunks(range(3), 0)) == [[0, 1, 2]]
+        assert list(helper.chunks([], 2)) == []
+        assert list(helper.chunks([], 0)) == []
+
+    def test_rows_per_second(self):
+        assert helper.rows_per_second(100, timedelta(seconds=2)) == 50.0
+        assert helper.rows_per_second(100, timedelta(0)) == 0.0
+
+    def test_point_wkb(self):
+        wkb = helper.point_wkb(13.5, 52.5)
+        assert len(wkb) == 21
+        assert wkb[:5] == b'\x01\x01\x00\x00\x00'
+        assert struct.unpack('<dd', wkb[5:]) == (13.5, 52.5)
+
+    def test_linestring_wkb(self):
+        wkb = helper.linestring_wkb([13.5, 52.5, 13.25, 52.75])
+        assert len(wkb) == 9 + 4 * 8
+        assert wkb[:9] == b'\x01\x02\x00\x00\x00\x02\x00\x00\x00'
+        assert struct.unpack('<4d', wkb[9:]) == (13.5, 52.5, 13.25, 52.75)
+
+    def test_polygons_from_wkb(self):
+        square = array('d', [0, 0, 4, 0, 4, 4, 0, 0])
+        hole = array('d', [1, 1, 2, 1, 2, 2, 1, 1])
+        polygon = struct.pack('<BIII8dI8d', 1, 3, 2, 4,
+                              *(square.tolist() + [4] + hole.tolist()))
+        assert helper.polygons_from_wkb(polygon) == [[square, hole]]
+
+        big_endian = struct.pack('>BIII8d', 0, 3, 1, 4, *square)
+        multipolygon = struct.pack('<BII', 1, 6, 2) + polygon + big_endian
+        assert helper.polygons_from_wkb(multipolygon) == \
+            [[square, hole], [square]]
+
+        with pytest.raises(ValueError):
+            helper.polygons_from_wkb(helper.point_wkb(13.4, 52.5))
+
+    def test_get_file_stat(self, gpx_path):
+        size, mtime_ns, inode = helper.get_file_stat(gpx_path)
+
+        assert size == os.path.getsize(gpx_path)
+        # within the precision of the float st_mtime
+        assert abs(mtime_ns - os.stat(gpx_path).st_mtime * 1e9) < 1e3
+        assert inode == os.stat(gpx_path).st_ino
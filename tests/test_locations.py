@@ -0,0 +1,191 @@
+import random
+from array import array
+from gpx2spatialite import locations
+
+
+def ring(*coords):
+    return array('d', [value for coord in coords for value in coord])
+
+
+SQUARE = ring((0, 0), (4, 0), (4, 4), (0, 4), (0, 0))
+HOLE = ring((1, 1), (2, 1), (2, 2), (1, 2), (1, 1))
+TRIANGLE = ring((3, 3), (6, 3), (3, 6), (3, 3))
+
+
+class TestLocations:
+
+    def test_orientation(self):
+        assert locations.orientation(0, 0, 1, 0, 0.5, 1) == 1
+        assert locations.orientation(0, 0, 1, 0, 0.5, -1) == -1
+        assert locations.orientation(0, 0, 1, 1, 0.5, 0.5) == 0
+        # the rounded determinant of this point is 0, it lies left of
+        # the line
+        assert locations.orientation(0.1, 0.1, 0.3, 0.3, 0.2,
+                                     0.2000000000000001) == 1
+
+    def test_locate_in_ring(self):
+        assert locations.locate_in_ring(2, 3, SQUARE) == 1
+        assert locations.locate_in_ring(5, 3, SQUARE) == 0
+        assert locations.locate_in_ring(-1, 0, SQUARE) == 0
+        # vertices and edges are on the ring
+        assert locations.locate_in_ring(0, 0, SQUARE) == -1
+        assert locations.locate_in_ring(4, 2, SQUARE) == -1
+        assert locations.locate_in_ring(2, 4, SQUARE) == -1
+        assert locations.locate_in_ring(4.5, 4.5, TRIANGLE) == -1
+
+    def test_polygon_contains(self):
+        assert locations.polygon_contains([SQUARE, HOLE], 3, 3)
+        assert not locations.polygon_contains([SQUARE, HOLE], 1.5, 1.5)
+        assert not locations.polygon_contains([SQUARE, HOLE], 1, 1.5)
+        assert not locations.polygon_contains([SQUARE], 0, 2)
+
+    def test_polygon_contains_box(self):
+        assert locations.polygon_contains_box([SQUARE], 0.5, 0.5, 3, 3)
+        assert not locations.polygon_contains_box([SQUARE], 0.5, 0.5, 4, 3)
+        assert not locations.polygon_contains_box([SQUARE], 3, 3, 5, 5)
+        # the hole lies inside the box
+        assert not locations.polygon_contains_box([SQUARE, HOLE],
+                                                  0.5, 0.5, 3, 3)
+        assert locations.polygon_contains_box([SQUARE, HOLE],
+                                              2.5, 0.5, 3, 3)
+        # all corners are inside, an edge of the polygon is not
+        notch = ring((0, 0), (4, 0), (4, 4), (2, 1), (0, 4), (0, 0))
+        assert not locations.polygon_contains_box([notch], 0.5, 0.5, 3.5, 3)
+
+    def test_strtree(self):
+        random.seed(0)
+        boxes = []
+        for index in range(200):
+            x = random.uniform(-100, 100)
+            y = random.uniform(-50, 50)
+            boxes.append(((x, y, x + random.uniform(0, 20),
+                           y + random.uniform(0, 10)), index))
+        tree = locations.STRtree(boxes, node_capacity=4)
+        assert len(tree) == 200
+
+        for index in range(500):
+            x = random.uniform(-110, 130)
+            y = random.uniform(-60, 70)
+            expected = [item for (minx, miny, maxx, maxy), item in boxes
+                        if minx <= x <= maxx and miny <= y <= maxy]
+            assert sorted(tree.query(x, y)) == expected
+
+        assert locations.STRtree([]).query(0, 0) == []
+
+    def test_citydef_index(self):
+        index = locations.CitydefIndex([
+            (1, [[ring((0, 0), (0, 0), (0, 0), (0, 0), (0, 0))]]),
+            (2, [[SQUARE, HOLE]]),
+            (4, [[TRIANGLE], [ring((10, 10), (11, 10), (11, 11),
+                                   (10, 10))]]),
+            (3, [[TRIANGLE]]),
+        ])
+        # the polygon of 'Unknown' has no area and is left out
+        assert len(index) == 4
+
+        assert index.locate(0.5, 0.5) == 2
+        assert index.locate(1.5, 1.5) == locations.UNKNOWN_LOCATION
+        # overlapping citydefs give the lowest citydef_uid
+        assert index.locate(3.5, 3.5) == 2
+        assert index.locate(5, 3.5) == 3
+        assert index.locate(10.8, 10.5) == 4
+        assert index.locate(0, 0) == locations.UNKNOWN_LOCATION
+        assert index.locate(50, 50) == locations.UNKNOWN_LOCATION
+
+    def test_locate_segment(self):
+        citydefs = [
+            (2, [[SQUARE, HOLE]]),
+            (3, [[TRIANGLE]]),
+            (4, [[ring((10, 10), (20, 10), (20, 20), (10, 20), (10, 10))]]),
+            (5, [[ring((12, 12), (14, 12), (14, 14), (12, 14), (12, 12))]]),
+        ]
+        # cells this large lie on boundaries and are never used
+        index = locations.CitydefIndex(citydefs, cell_size=100)
+        reference = locations.CitydefIndex(citydefs)
+
+        def locate_segment(lons, lats):
+            locs = index.locate_segment(array('d', lons), array('d', lats))
+            assert locs.tolist() == [reference(lon, lat)
+                                     for lon, lat in zip(lons, lats)]
+            return locs.tolist()
+
+        index.reset_stats()
+        assert locate_segment([2.5, 3, 3.5], [0.5, 1, 2]) == [2, 2, 2]
+        assert index.stats == {'points': 3, 'bounds_hits': 3, 'rejects': 0,
+                               'cell_hits': 0, 'previous_hits': 0}
+
+        # crossing the hole and into the triangle, where the square wins.
+        # The triangle overlaps the square and is not reused.
+        index.reset_stats()
+        assert locate_segment([0.5, 0.6, 1.5, 3.5, 5, 5.1, 7],
+                              [0.5, 0.6, 1.5, 3.5, 3.5, 3.6, 7]) == \
+            [2, 2, 1, 2, 3, 3, 1]
+        assert index.stats['bounds_hits'] == 0
+        assert index.stats['previous_hits'] == 1
+
+        index.reset_stats()
+        assert locate_segment([13, 13.5, 25], [13, 13.5, 25]) == [4, 4, 1]
+        assert locations.format_stats(index.stats) == (
+            "Located 3 points: 0.0% by segment bounds, 33.3% outside of all "
+            "citydefs, 0.0% by grid cell, 33.3% by the previous point's "
+            "citydef, 33.3% searched")
+        assert index.locate_segment(array('d'), array('d')) == array('l')
+
+    def test_coverage(self):
+        index = locations.CitydefIndex([
+            (2, [[SQUARE, HOLE]]),
+            (3, [[ring((-20, -10), (-19, -10), (-19, -9), (-20, -10))]]),
+        ], coverage_resolution=1)
+        assert index.envelope == (-20, -10, 4, 4)
+
+        assert index.covers(-19.5, -9.8)
+        assert index.covers(0.5, 0.5)
+        # the hole is inside the bounds of the square
+        assert index.covers(1.5, 1.5)
+        # cells touched by the bounds of a polygon
+        assert index.covers(4, 4)
+        assert index.covers(-18.5, -9.5)
+        assert not index.covers(-10, -5)
+        assert not index.covers(4.5, 0)
+        assert not index.covers(180, 90)
+        assert not index.covers(float('nan'), 0)
+
+        index.reset_stats()
+        assert index(-10, -5) == locations.UNKNOWN_LOCATION
+        assert index.locate_segment(array('d', [-10, 0.5, 50]),
+                                    array('d', [-5, 0.5, 50])).tolist() == \
+            [locations.UNKNOWN_LOCATION, 2, locations.UNKNOWN_LOCATION]
+        assert index.stats['rejects'] == 3
+        assert index.cells == {(50, 50): (2, index.tree.query(0.5, 0.5)[0])}
+
+        assert not locations.CitydefIndex([]).covers(0, 0)
+
+    def test_cells(self):
+        index = locations.CitydefIndex([(2, [[SQUARE, HOLE]]),
+                                        (3, [[TRIANGLE]])],
+                                       cell_size=0.3, max_cells=3)
+
+        assert index(0.7, 0.7) == 2
+        assert index(0.8, 0.65) == 2
+        assert index(3.2, 3.2) == 2
+        assert index(10.2, 10.2) == locations.UNKNOWN_LOCATION
+        assert index(1.5, 1.5) == locations.UNKNOWN_LOCATION
+        # cells on a boundary are tested exactly
+        assert index(1.0, 1.2) == locations.UNKNOWN_LOCATION
+        assert index.stats['cell_hits'] == 4
+        assert index.stats['rejects'] == 1
+        assert index.stats['points'] == 6
+
+        # the least recently used cells were dropped, (10.2, 10.2) is
+        # outside the envelope and got no cell
+        assert list(index.cells) == [(10, 10), (5, 5), (3, 4)]
+        assert index.cells[(3, 4)] is None
+        assert index.cells[(5, 5)] == (locations.UNKNOWN_LOCATION, None)
+
+        assert locations.classify_box([SQUARE, HOLE], 0.5, 0.5, 0.9, 0.9) \
+            == 1
+        assert locations.classify_box([SQUARE, HOLE], 1.2, 1.2, 1.8, 1.8) \
+            == 0
+        assert locations.classify_box([SQUARE, HOLE], 0.5, 0.5, 1.5, 1.5) \
+            == -1
+        assert locations.classify_box([HOLE], 0, 0, 3, 3) == -1
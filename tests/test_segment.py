@@ -0,0 +1,130 @@
+import pickle
+import pytest
+from array import array
+from datetime import datetime
+from gpxpy import gpxfield
+from gpx2spatialite import gpx
+from gpx2spatialite import locations
+from gpx2spatialite import segment
+
+
+@pytest.mark.usefixtures("gpx_path")
+class TestSegment:
+    def test_to_epoch(self):
+        assert segment.to_epoch(datetime(1970, 1, 2, 0, 0, 1)) == 86401.0
+        assert segment.to_epoch(datetime(2012, 3, 17, 12, 46, 19, 500000)) \
+            == 1331988379.5
+        assert segment.to_epoch(None) != segment.to_epoch(None)
+
+    def test_parse_utc_timestamp(self):
+        assert segment.parse_utc_timestamp('2012-03-17T12:46:19Z') == \
+            1331988379.0
+        assert segment.parse_utc_timestamp('1970-01-02T00:00:01Z') == 86401.0
+        # other forms are left to gpxpy
+        assert segment.parse_utc_timestamp('2012-03-17T12:46:19.5Z') is None
+        assert segment.parse_utc_timestamp('2012-03-17T12:46:19+02:00') \
+            is None
+        assert segment.parse_utc_timestamp('2012-13-17T12:46:19Z') is None
+        assert segment.parse_utc_timestamp('2012-03-17T24:46:19Z') is None
+        assert segment.parse_utc_timestamp('2012-03-17T12:46:+9Z') is None
+
+    def test_parse_time(self):
+        for text in ('2012-03-17T12:46:19Z', '2012-03-17T12:46:19.25Z',
+                     '2012-03-17T12:46:19+02:00', '2012-02-30T12:46:19Z',
+                     'noon', None):
+            expected = gpxfield.TIME_TYPE.from_string(text)
+            actual = segment.parse_time(text)
+            assert actual == expected
+            assert str(actual) == str(expected)
+
+    def test_get_timestamps(self):
+        seg = segment.TrackSegment('segment-uuid')
+        for text in ('2012-03-17T23:59:59Z', '2012-03-18T00:00:00Z',
+                     '2012-03-18T00:00:00.25Z', None):
+            seg.append(13.4, 52.5, 0, text, 0, 0)
+
+        times = [gpxfield.TIME_TYPE.from_string(text) for text in
+                 ('2012-03-17T23:59:59Z', '2012-03-18T00:00:00Z',
+                  '2012-03-18T00:00:00.25Z')] + [None]
+        assert seg.get_times() == times
+        assert seg.get_timestamps() == [str(time) for time in times]
+        assert seg.get_time_bounds() == (times[0], times[2])
+
+        seg = segment.TrackSegment('segment-uuid')
+        time = gpxfield.TIME_TYPE.from_string('2012-03-18T01:30:00+02:00')
+        seg.append(13.4, 52.5, 0, time, 0, 0)
+        assert seg.get_timestamps() == [str(time)]
+
+    def test_mixed_offsets(self):
+        texts = ['2012-03-17T14:46:19+02:00', '2012-03-17T12:47:19Z',
+                 '2012-03-17T13:48:19+01:00', '2012-03-17T14:49:19+02:00']
+        times = [gpxfield.TIME_TYPE.from_string(text) for text in texts]
+        naive = datetime(2012, 3, 17, 12, 50, 19)
+        seg = segment.TrackSegment('segment-uuid')
+        for text in texts:
+            seg.append(13.4, 52.5, 0, text, 0, 0)
+        seg.append(13.4, 52.5, 0, naive, 0, 0)
+
+        assert seg.get_timestamps() == [
+            '2012-03-17 14:46:19+02:00', '2012-03-17 12:47:19+00:00',
+            '2012-03-17 13:48:19+01:00', '2012-03-17 14:49:19+02:00',
+            '2012-03-17 12:50:19']
+        assert seg.get_timestamps() == [str(time)
+                                        for time in times + [naive]]
+        assert [str(time) for time in seg.get_times()] == \
+            seg.get_timestamps()
+        assert sorted(seg.other_times) == [1, 2, 4]
+
+        # a naive first point, then a utc timestamp
+        seg = segment.TrackSegment('segment-uuid')
+        seg.append(13.4, 52.5, 0, naive, 0, 0)
+        seg.append(13.4, 52.5, 0, '2012-03-17T12:51:19Z', 0, 0)
+        assert seg.get_timestamps() == ['2012-03-17 12:50:19',
+                                        '2012-03-17 12:51:19+00:00']
+        start, end = seg.get_time_bounds()
+        assert str(start) == '2012-03-17 12:50:19'
+        assert str(end) == '2012-03-17 12:51:19+00:00'
+
+    def test_pickle_offsets(self):
+        seg = segment.TrackSegment('segment-uuid')
+        seg.append(13.4, 52.5, 0, '2012-03-17T14:46:19+02:00', 0, 0)
+        seg.append(13.4, 52.5, 0, '2012-03-17T12:47:19Z', 0, 0)
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(seg, protocol))
+            assert copy.get_timestamps() == seg.get_timestamps()
+
+    def test_track_segment(self):
+        seg = segment.TrackSegment('segment-uuid')
+        seg.append(13.4, 52.5, 35.0, datetime(2012, 3, 17, 12, 46, 19),
+                   0, 0)
+        seg.append(13.5, 52.6, 36.0, None, 1.5, 45.0)
+
+        assert len(seg) == 2
+        assert seg.get_times() == [datetime(2012, 3, 17, 12, 46, 19), None]
+        assert seg.get_timestamps() == ['2012-03-17 12:46:19', 'None']
+        assert seg.get_point_geometries() == ['Point(13.4 52.5)',
+                                              'Point(13.5 52.6)']
+        assert seg.get_linestring() == 'LINESTRING(13.4 52.5,13.5 52.6)'
+        assert seg.get_linestring(wkb=True)[:9] == \
+            b'\x01\x02\x00\x00\x00\x02\x00\x00\x00'
+
+        seg.locate(lambda lon, lat: 2 if lon < 13.45 else 1)
+        assert list(seg.loc) == [2, 1]
+
+        index = locations.CitydefIndex([(2, [[array('d', [
+            13.3, 52.4, 13.45, 52.4, 13.45, 52.7, 13.3, 52.7, 13.3, 52.4])]])])
+        seg.locate(index)
+        assert list(seg.loc) == [2, 1]
+        assert index.stats['points'] == 2
+
+    def test_trackpoints(self, gpx_path):
+        extracted_points = gpx.extractpoints(gpx_path)
+        seg = [value for kind, value in gpx.iterextract(gpx_path)
+               if kind == 'segment'][0]
+
+        # segment uuids are random, compare everything else
+        assert [p[1:] for p in seg.trackpoints()] == \
+            [p[1:] for p in extracted_points[0]]
+        assert seg.trackline()[1:] == extracted_points[1][0][1:]
+        assert [str(p[3]) for p in extracted_points[0]] == \
+            seg.get_timestamps()
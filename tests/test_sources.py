@@ -0,0 +1,142 @@
+import pytest
+import gzip
+import hashlib
+import mmap
+import os
+import threading
+import tarfile
+import zipfile
+from gpx2spatialite import sources
+
+
+@pytest.fixture
+def gpx_sources(gpx_path, tmpdir):
+    with open(gpx_path, 'rb') as gpx_file:
+        content = gpx_file.read()
+
+    gz_path = str(tmpdir.join('file.gpx.gz'))
+    with gzip.open(gz_path, 'wb') as gz_file:
+        gz_file.write(content)
+
+    zip_path = str(tmpdir.join('tracks.zip'))
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        zip_file.write(gpx_path, '2012/file.gpx')
+        zip_file.writestr('readme.txt', 'no track')
+
+    tar_path = str(tmpdir.join('tracks.tar.gz'))
+    with tarfile.open(tar_path, 'w:gz') as tar_file:
+        tar_file.add(gpx_path, 'file.gpx')
+
+    return {'content': content, 'gz': gz_path, 'zip': zip_path,
+            'tar': tar_path}
+
+
+@pytest.mark.usefixtures("gpx_path")
+class TestSources:
+    def test_is_gpx_path(self):
+        assert sources.is_gpx_path('a/file.gpx', '.gpx')
+        assert sources.is_gpx_path('a/file.GPX.gz', '.gpx')
+        assert sources.is_gpx_path('a/file.gpx.bz2', '.gpx')
+        assert not sources.is_gpx_path('a/file.txt.gz', '.gpx')
+        assert not sources.is_gpx_path('a/tracks.tar.gz', '.gpx')
+
+    def test_list_archive(self, gpx_sources):
+        zip_path = gpx_sources['zip']
+        tar_path = gpx_sources['tar']
+
+        assert sources.list_archive(zip_path, '.gpx') == \
+            [zip_path + '/2012/file.gpx']
+        assert sources.list_archive(tar_path, '.gpx') == \
+            [tar_path + '/file.gpx']
+        assert sources.list_archive(gpx_sources['gz'], '.gpx') == []
+
+    def test_split_archive_path(self, gpx_path, gpx_sources):
+        zip_path = gpx_sources['zip']
+
+        assert sources.split_archive_path(gpx_path) == (gpx_path, None)
+        assert sources.split_archive_path(zip_path + '/2012/file.gpx') == \
+            (zip_path, '2012/file.gpx')
+
+    def test_open_source(self, gpx_path, gpx_sources):
+        content = gpx_sources['content']
+        for filepath in (gpx_path, gpx_sources['gz'],
+                         gpx_sources['zip'] + '/2012/file.gpx',
+                         gpx_sources['tar'] + '/file.gpx'):
+            with sources.open_source(filepath) as source:
+                assert source.read() == content
+
+        with pytest.raises(IOError):
+            sources.open_source(gpx_sources['tar'] + '/missing.gpx')
+
+    def test_archive_reader(self, gpx_sources, tmpdir):
+        content = gpx_sources['content']
+        md5hash = hashlib.md5(content).hexdigest()
+        tar_path = str(tmpdir.join('many.tar.bz2'))
+        with tarfile.open(tar_path, 'w:bz2') as tar_file:
+            for index in range(3):
+                tar_file.addfile(tarfile.TarInfo('empty{0}.gpx'.format(index)))
+
+        with sources.ArchiveReader() as archives:
+            # the hashes of all tar members are computed in one pass
+            assert archives.md5(gpx_sources['tar'], 'file.gpx') == md5hash
+            assert archives.md5s == {'file.gpx': md5hash}
+            with sources.open_source(gpx_sources['tar'] + '/file.gpx',
+                                     archives) as source:
+                assert source.read(5) == content[:5]
+                assert source.read() == content[5:]
+
+            assert archives.md5(gpx_sources['zip'], '2012/file.gpx') == \
+                md5hash
+            with sources.open_source(gpx_sources['zip'] + '/2012/file.gpx',
+                                     archives) as source:
+                assert source.read() == content
+
+            assert archives.md5(tar_path, 'empty1.gpx') == \
+                hashlib.md5(b'').hexdigest()
+            assert len(archives.md5s) == 3
+            with sources.open_source(tar_path + '/empty2.gpx',
+                                     archives) as source:
+                assert source.read() == b''
+            with pytest.raises(IOError):
+                archives.open(tar_path, 'missing.gpx')
+            with pytest.raises(IOError):
+                archives.md5(tar_path, 'missing.gpx')
+            assert archives.archive_path == tar_path
+        assert archives.archive is None
+
+    def test_open_mapped(self, gpx_path, tmpdir):
+        with open(gpx_path, 'rb') as gpx_file:
+            content = gpx_file.read()
+
+        source = sources.open_mapped(gpx_path)
+        assert isinstance(source, mmap.mmap)
+        assert source.read(5) == content[:5]
+        source.seek(0)
+        assert source.read() == content
+        source.close()
+
+        # empty files can not be mapped
+        empty_path = str(tmpdir.join('empty.gpx'))
+        open(empty_path, 'w').close()
+        with sources.open_mapped(empty_path) as source:
+            assert not isinstance(source, mmap.mmap)
+            assert source.read() == b''
+
+    @pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason="needs mkfifo")
+    def test_open_mapped_pipe(self, gpx_path, tmpdir):
+        with open(gpx_path, 'rb') as gpx_file:
+            content = gpx_file.read()
+
+        fifo_path = str(tmpdir.join('pipe.gpx'))
+        os.mkfifo(fifo_path)
+
+        def write_pipe():
+            with open(fifo_path, 'wb') as fifo:
+                fifo.write(content)
+
+        writer = threading.Thread(target=write_pipe)
+        writer.start()
+        with sources.open_mapped(fifo_path) as source:
+            assert not isinstance(source, mmap.mmap)
+            assert source.read() == content
+        writer.join()